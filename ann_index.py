@@ -0,0 +1,480 @@
+import os
+import sys
+import time
+import heapq
+import tempfile
+from itertools import islice
+
+import numpy as np
+
+# ---------------------------------------
+# Nearest-neighbour indexes over L2-normalized embeddings, where the inner
+# product is the cosine similarity. Both backends share one interface:
+#     add(vectors)                      -> row id of the first added vector
+#     search(query, k, group_bias, groups) -> (rows, scores), best first
+# group_bias / groups add a per-group offset to every scored row
+# (contextmatch passes its per-type keyword boosts and entity type codes).
+#
+# Both also take the same storage options:
+#     storage  "float32", "float16" or "int8" (per-row scale), see QuantizedVectors
+#     rescore  with a quantized storage, re-rank the best k * rescore rows
+#              with full-precision vectors read from `source`
+#     source   float32 vectors by row id, e.g. an np.load(..., mmap_mode="r")
+#              array, so they stay on disk / in the shared page cache
+# ---------------------------------------
+STORAGES = ("float32", "float16", "int8")
+
+# Rows dequantized at a time: bounds the float32 scratch to a few MB
+BLOCK_ROWS = 8192
+
+
+def top_rows(scores, k):
+    """
+    Positions of the k highest scores, best first and lower position first on
+    ties, as a stable sort of all scores would give. Only O(n) work on the full
+    vector: argpartition finds the k-th score, everything at or above it is sorted.
+    """
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    if k < len(scores):
+        kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        rows = np.flatnonzero(scores >= kth)
+    else:
+        rows = np.arange(len(scores))
+    return rows[np.lexsort((rows, -scores[rows]))][:k]
+
+
+def _as_matrix(vectors, dim=None):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1) if len(vectors) else vectors.reshape(0, dim or 0)
+    return vectors
+
+
+class QuantizedVectors:
+    def __init__(self, vectors, storage="float32"):
+        """
+        Row vectors kept as float32 (4 bytes / dim), float16 (2) or int8 (1, plus
+        a float32 scale per row: row = codes * scale). Scores are computed on the
+        stored form, dequantizing BLOCK_ROWS rows at a time for the BLAS product.
+        int8 scans about as fast as float32; numpy's float16 -> float32 conversion
+        is not vectorized on every CPU and can make a float16 scan several times slower.
+        """
+        if storage not in STORAGES:
+            raise ValueError(f"Unknown storage {storage!r}, expected one of {STORAGES}")
+        self.storage = storage
+        vectors = _as_matrix(vectors)
+        self.dim = vectors.shape[1]
+        self.data, self.scales = self._encode(vectors)
+
+    def _encode(self, vectors):
+        if self.storage == "float32":
+            return vectors, None
+        if self.storage == "float16":
+            return vectors.astype(np.float16), None
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def append(self, vectors):
+        data, scales = self._encode(_as_matrix(vectors, self.dim))
+        self.data = np.concatenate([self.data, data])
+        if scales is not None:
+            self.scales = np.concatenate([self.scales, scales])
+
+    def dot(self, query, rows=None):
+        """
+        Scores of all rows (or of `rows`) against one float32 query, or against
+        an (m, dim) batch of queries as an (m, rows) matrix.
+        """
+        data = self.data if rows is None else self.data[rows]
+        if self.storage == "float32":
+            return data @ query if query.ndim == 1 else query @ data.T
+        scores = np.empty(query.shape[:-1] + (len(data),), dtype=np.float32)
+        for start in range(0, len(data), BLOCK_ROWS):
+            block = data[start:start + BLOCK_ROWS].astype(np.float32)
+            scores[..., start:start + BLOCK_ROWS] = block @ query if query.ndim == 1 else query @ block.T
+        if self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+
+def _best(rows, scores, k):
+    """Best k of (rows, scores), ties going to the lower row id"""
+    best = top_rows(scores, k)
+    best = best[np.lexsort((rows[best], -scores[best]))]
+    return rows[best], scores[best]
+
+
+def _rescore(rows, scores, k, query, source, rescore, group_bias, groups):
+    """(rows, scores) cut to the best k * rescore, rescored with full-precision vectors from `source`"""
+    rows, scores = _best(rows, scores, k * rescore)
+    scores = scores.copy()
+    # Rows added after `source` was written keep their quantized score
+    exact = np.flatnonzero(rows < len(source))
+    if len(exact):
+        # Read in row order, which is sequential on a memory-mapped source
+        order = exact[np.argsort(rows[exact])]
+        vectors = np.asarray(source[rows[order]], dtype=np.float32)
+        scores[order] = vectors @ query
+        if group_bias is not None:
+            scores[order] += group_bias[groups[rows[order]]]
+    return rows, scores
+
+
+class ExactIndex:
+    def __init__(self, vectors, storage="float32", rescore=0, source=None):
+        """Brute-force scan over every vector; the reference the approximate backends are measured against"""
+        self.vectors = QuantizedVectors(vectors, storage)
+        self.rescore = rescore if storage != "float32" and source is not None else 0
+        self.source = source
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes
+
+    def add(self, vectors):
+        first = len(self.vectors)
+        self.vectors.append(vectors)
+        return first
+
+    def search(self, query, k, group_bias=None, groups=None):
+        query = np.asarray(query, dtype=np.float32)
+        scores = self.vectors.dot(query)
+        if group_bias is not None and np.any(group_bias):
+            scores += group_bias[groups[:len(scores)]]
+        else:
+            group_bias = None
+        rows = np.arange(len(scores))
+        if self.rescore:
+            rows, scores = _rescore(rows, scores, k, query, self.source, self.rescore, group_bias, groups)
+        return _best(rows, scores, k)
+
+    def search_batch(self, queries, k, group_bias=None, groups=None):
+        """
+        search() for every row of `queries`, scored with one matrix product;
+        group_bias then has one row per query. Returns a list of (rows, scores).
+        """
+        queries = _as_matrix(queries, self.vectors.dim)
+        scores = self.vectors.dot(queries)
+        if group_bias is not None and np.any(group_bias):
+            scores += np.asarray(group_bias)[:, groups[:scores.shape[1]]]
+        else:
+            group_bias = None
+        rows = np.arange(scores.shape[1])
+        results = []
+        for i, query in enumerate(queries):
+            if self.rescore:
+                bias = None if group_bias is None else group_bias[i]
+                results.append(_best(*_rescore(rows, scores[i], k, query, self.source, self.rescore, bias, groups), k))
+            else:
+                results.append(_best(rows, scores[i], k))
+        return results
+
+
+class IVFFlatIndex:
+    def __init__(self, vectors, nlist=None, nprobe=8, train_size=50000, iterations=10, seed=0,
+                 storage="float32", rescore=0, source=None):
+        """
+        Inverted-file index: vectors are clustered around nlist centroids
+        (spherical k-means on a sample of train_size vectors) and a query only
+        scans the vectors of its nprobe closest clusters.
+
+        nlist: number of clusters, default 4 * sqrt(n)
+        nprobe: clusters scanned per query; raise for recall, lower for latency.
+            Can be changed at any time.
+        Vectors added later go to their closest centroid; the centroids are not
+        retrained, so call train() again after the data drifts a lot.
+        storage / rescore / source: see the module comment; centroids stay float32.
+        """
+        vectors = _as_matrix(vectors)
+        if not len(vectors):
+            raise ValueError("IVFFlatIndex needs vectors to train its clusters on")
+        self.dim = vectors.shape[1]
+        self.nlist = nlist or max(1, int(4 * np.sqrt(len(vectors))))
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.iterations = iterations
+        self.seed = seed
+        self.storage = storage
+        self.rescore = rescore if storage != "float32" and source is not None else 0
+        self.source = source
+        self.size = 0
+        self.train(vectors)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return self.centroids.nbytes + sum(rows.nbytes + vectors.nbytes
+                                           for rows, vectors in zip(self.list_rows, self.list_vectors))
+
+    # ---------------------------
+    # Building
+    # ---------------------------
+    def _nearest(self, vectors, chunk=8192):
+        """Closest centroid of every vector, in chunks to bound the score matrix"""
+        out = np.empty(len(vectors), dtype=np.intp)
+        for start in range(0, len(vectors), chunk):
+            out[start:start + chunk] = (vectors[start:start + chunk] @ self.centroids.T).argmax(axis=1)
+        return out
+
+    def train(self, vectors):
+        """(Re)cluster `vectors`, which become the whole content of the index (rows 0..n-1)"""
+        vectors = _as_matrix(vectors)
+        rng = np.random.default_rng(self.seed)
+        nlist = min(self.nlist, len(vectors))
+        sample = vectors
+        if len(vectors) > self.train_size:
+            sample = vectors[rng.choice(len(vectors), self.train_size, replace=False)]
+        self.centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            assign = self._nearest(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            # Empty clusters restart from random sample points
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            self.centroids = (sums / np.maximum(norms, 1e-12)).astype(np.float32)
+
+        self.list_rows = [np.zeros(0, dtype=np.int64) for _ in range(nlist)]
+        self.list_vectors = [QuantizedVectors(np.zeros((0, self.dim), dtype=np.float32), self.storage)
+                             for _ in range(nlist)]
+        self.size = 0
+        self.add(vectors)
+
+    def add(self, vectors):
+        """Insert vectors as rows len(self).. ; returns the first new row id"""
+        vectors = _as_matrix(vectors, self.dim)
+        first = self.size
+        rows = np.arange(first, first + len(vectors), dtype=np.int64)
+        assign = self._nearest(vectors)
+        order = np.argsort(assign, kind="stable")
+        lists, starts = np.unique(assign[order], return_index=True)
+        for lst, chunk in zip(lists.tolist(), np.split(order, starts[1:])):
+            self.list_rows[lst] = np.concatenate([self.list_rows[lst], rows[chunk]])
+            self.list_vectors[lst].append(vectors[chunk])
+        self.size += len(vectors)
+        return first
+
+    # ---------------------------
+    # Search
+    # ---------------------------
+    def search(self, query, k, group_bias=None, groups=None):
+        query = np.asarray(query, dtype=np.float32)
+        probe = top_rows(self.centroids @ query, self.nprobe).tolist()
+        rows = np.concatenate([self.list_rows[lst] for lst in probe])
+        scores = np.concatenate([self.list_vectors[lst].dot(query) for lst in probe])
+        if group_bias is not None and np.any(group_bias):
+            scores += group_bias[groups[rows]]
+        else:
+            group_bias = None
+        if self.rescore:
+            rows, scores = _rescore(rows, scores, k, query, self.source, self.rescore, group_bias, groups)
+        return _best(rows, scores, k)
+
+    def search_batch(self, queries, k, group_bias=None, groups=None):
+        """search() per query: each one scans its own clusters, so there is no shared product"""
+        return [self.search(query, k, None if group_bias is None else group_bias[i], groups)
+                for i, query in enumerate(_as_matrix(queries, self.dim))]
+
+
+BACKENDS = {"exact": ExactIndex, "ivf": IVFFlatIndex}
+
+
+def make_index(backend, vectors, **options):
+    """Index of `vectors` with the backend named in BACKENDS, options passed to its constructor"""
+    try:
+        cls = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown ANN backend {backend!r}, expected one of {sorted(BACKENDS)}") from None
+    return cls(vectors, **options)
+
+
+def shard_order(groups):
+    """Rows regrouped by group, in row order within a group: the layout ShardedIndex stores"""
+    return np.argsort(np.asarray(groups), kind="stable")
+
+
+class ShardedIndex:
+    def __init__(self, vectors, groups, backend="exact", source=None, **options):
+        """
+        One index per group (e.g. entity type) over that group's rows, each
+        holding its own contiguous copy, so a query restricted to some groups
+        only scans their memory. Results of several shards are merged with a heap.
+
+        groups: group code of every row
+        source: float32 vectors for rescoring, in shard_order(groups) order
+            (a memory-mapped file then gives each shard a slice, not a copy)
+        options: passed to make_index() for every shard
+        """
+        vectors = _as_matrix(vectors)
+        groups = np.asarray(groups, dtype=np.intp)
+        self.dim = vectors.shape[1]
+        self.backend = backend
+        self.options = options
+        self.size = len(vectors)
+        self.shards = {}  # group -> (global row of each shard row, index)
+        order = shard_order(groups)
+        codes, starts = np.unique(groups[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for group, start, end in zip(codes.tolist(), starts.tolist(), ends.tolist()):
+            rows = order[start:end].astype(np.int64)
+            shard_options = dict(options)
+            if source is not None:
+                shard_options["source"] = source[start:end]
+            self.shards[group] = (rows, make_index(backend, vectors[rows], **shard_options))
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return sum(rows.nbytes + index.nbytes for rows, index in self.shards.values())
+
+    def add(self, vectors, groups):
+        """Append vectors as rows len(self).. to the shards of their groups; returns the first new row id"""
+        vectors = _as_matrix(vectors, self.dim)
+        groups = np.asarray(groups, dtype=np.intp)
+        first = self.size
+        for group in np.unique(groups).tolist():
+            chunk = np.flatnonzero(groups == group)
+            new_rows = first + chunk.astype(np.int64)
+            if group in self.shards:
+                rows, index = self.shards[group]
+                index.add(vectors[chunk])
+                self.shards[group] = (np.concatenate([rows, new_rows]), index)
+            else:
+                options = {key: value for key, value in self.options.items() if key != "source"}
+                self.shards[group] = (new_rows, make_index(self.backend, vectors[chunk], **options))
+        self.size += len(vectors)
+        return first
+
+    def search(self, query, k, group_bias=None, groups=None, only=None):
+        """
+        Like the other backends; `only` restricts the search to those groups.
+        `groups` is accepted for interface parity and ignored: the shards know
+        their group, and the bias of a shard is one constant added to its scores.
+        """
+        found = [(group, rows, index.search(query, k)) for group, (rows, index) in self._shards(only)]
+        return self._merge(found, k, group_bias)
+
+    def search_batch(self, queries, k, group_bias=None, groups=None, only=None):
+        """search() for every row of `queries`, each shard scoring the whole batch at once"""
+        found = [(group, rows, index.search_batch(queries, k)) for group, (rows, index) in self._shards(only)]
+        return [self._merge([(group, rows, results[i]) for group, rows, results in found], k,
+                            None if group_bias is None else group_bias[i])
+                for i in range(len(queries))]
+
+    def _shards(self, only):
+        if only is None:
+            return self.shards.items()
+        return [(group, self.shards[group]) for group in only if group in self.shards]
+
+    @staticmethod
+    def _merge(found, k, group_bias):
+        """Best k over per-shard (group, rows, (local rows, scores)) results"""
+        ranked = []
+        for group, rows, (local, scores) in found:
+            if group_bias is not None:
+                scores = (scores + group_bias[group]).astype(np.float32)
+            # Best first within a shard, and shard rows ascend with their global rows
+            ranked.append(zip((-scores).tolist(), rows[local].tolist()))
+        best = list(islice(heapq.merge(*ranked), k))
+        return (np.array([row for _, row in best], dtype=np.int64),
+                np.array([-score for score, _ in best], dtype=np.float32))
+
+
+# ---------------------------------------
+# Benchmark: recall and latency of an index against the exact scan
+# ---------------------------------------
+def benchmark(index, exact, queries, k=10):
+    """
+    recall@k of `index` (share of the exact top-k it returns) and per-query
+    latency percentiles in ms of both, over `queries` (one per row).
+    """
+    def timed(idx):
+        results, times = [], []
+        for query in queries:
+            started = time.perf_counter()
+            rows, _ = idx.search(query, k)
+            times.append((time.perf_counter() - started) * 1000)
+            results.append(set(rows.tolist()))
+        return results, np.array(times)
+
+    truth, exact_ms = timed(exact)
+    found, index_ms = timed(index)
+    recall = np.mean([len(t & f) / max(len(t), 1) for t, f in zip(truth, found)])
+    return {
+        "recall": float(recall),
+        "p50_ms": float(np.percentile(index_ms, 50)),
+        "p99_ms": float(np.percentile(index_ms, 99)),
+        "exact_p50_ms": float(np.percentile(exact_ms, 50)),
+        "exact_p99_ms": float(np.percentile(exact_ms, 99)),
+    }
+
+
+def synthetic_embeddings(n, dim, clusters=1000, noise=0.35, seed=0):
+    """Clustered unit vectors, a stand-in for real entity embeddings"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + noise * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+# ---------------------------------------
+# Example: python ann_index.py [n] [dim]
+# ---------------------------------------
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else 384
+    vectors = synthetic_embeddings(n, dim)
+    # Queries land near existing entities, as real lookups do
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(n, 200)] + 0.05 * rng.standard_normal((200, dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    exact = ExactIndex(vectors)
+    started = time.perf_counter()
+    ivf = IVFFlatIndex(vectors)
+    print(f"{n} x {dim}: IVF build {time.perf_counter() - started:.1f}s, nlist={ivf.nlist}")
+    for nprobe in (1, 4, 16, 64):
+        ivf.nprobe = nprobe
+        stats = benchmark(ivf, exact, queries)
+        print(f"nprobe={nprobe:3d}  recall@10={stats['recall']:.3f}  "
+              f"p50={stats['p50_ms']:.2f}ms  p99={stats['p99_ms']:.2f}ms  "
+              f"(exact p50={stats['exact_p50_ms']:.2f}ms  p99={stats['exact_p99_ms']:.2f}ms)")
+
+    # Quantized storage of the exact scan, alone and with a rescored shortlist
+    # read from a memory-mapped float32 copy
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "vectors.npy")
+        np.save(path, vectors)
+        source = np.load(path, mmap_mode="r")
+        print(f"float32: {exact.nbytes / n:.0f} bytes/vector")
+        for storage in ("float16", "int8"):
+            for rescore in (0, 4):
+                index = ExactIndex(vectors, storage=storage, rescore=rescore, source=source)
+                stats = benchmark(index, exact, queries)
+                print(f"{storage:7s} rescore={rescore}  {index.nbytes / n:.0f} bytes/vector  "
+                      f"recall@10={stats['recall']:.3f}  p50={stats['p50_ms']:.2f}ms  "
+                      f"p99={stats['p99_ms']:.2f}ms")
+        ivf = IVFFlatIndex(vectors, nprobe=16, storage="int8", rescore=4, source=source)
+        stats = benchmark(ivf, exact, queries)
+        print(f"ivf nprobe=16 int8 rescore=4  {ivf.nbytes / n:.0f} bytes/vector  "
+              f"recall@10={stats['recall']:.3f}  p50={stats['p50_ms']:.2f}ms  p99={stats['p99_ms']:.2f}ms")
+        del source, ivf
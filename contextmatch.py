@@ -1,8 +1,19 @@
+import os
+import sys
 import json
+import time
+import atexit
 import re
-from sentence_transformers import SentenceTransformer, util
-from rapidfuzz import fuzz
+import hashlib
+import tempfile
+import ahocorasick
+from rapidfuzz import fuzz, process
 import numpy as np
+from master_store import MasterStore
+from result_cache import ResultCache
+from ann_index import top_rows, shard_order, ShardedIndex
+from vocabulary import Vocabulary
+from normalizer import Normalizer
 
 # -----------------------------
 # 1. Load your entity data
@@ -3164,76 +3175,512 @@ boost_map = {
 # -----------------------------
 # 3. Create embeddings
 # -----------------------------
-model = SentenceTransformer('all-MiniLM-L6-v2')
-entity_names = [e["name"] for e in entities]
-entity_embeddings = model.encode(entity_names, convert_to_tensor=True)
+# Columnar copy of `entities`: row i is entities[i], category is the entity type
+entity_store = MasterStore.from_records((e["type"], i, e["name"]) for i, e in enumerate(entities))
+
+# Model and entity embeddings are created on first use, so importing this module
+# (e.g. only for clean_query) stays cheap. Entity embeddings are cached on disk
+# per model, keyed by a hash of each distinct name.
+MODEL_NAME = 'all-MiniLM-L6-v2'
+EMBEDDING_CACHE_DIR = os.environ.get(
+    "CONTEXTMATCH_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".embedding_cache"),
+)
+
+# Decoded once: the search loops index these instead of decoding from the store per entity
+_all_rows = range(len(entity_store))
+entity_names = entity_store.names.decode(_all_rows)
+entity_names_lower = entity_store.names_lower.decode(_all_rows)
+entity_types = [entity_store.category(row) for row in _all_rows]
+# fuzz.token_sort_ratio(q, name) is fuzz.ratio over whitespace tokens sorted,
+# so names are token-sorted once here and only the query is sorted per search
+entity_names_sorted = [" ".join(sorted(name.split())) for name in entity_names_lower]
+# Type of each entity as an index into entity_store.categories, for per-type vectors
+entity_type_codes = np.asarray(entity_store.cat_codes, dtype=np.intp)
+
+# Query encoder: "float" is get_model() itself; "int8" is a second copy of
+# MODEL_NAME with its Linear layers dynamically quantized to int8 and inputs cut
+# to QUERY_MAX_SEQ_LENGTH tokens, enough for short finance questions. Entity
+# embeddings always come from the float model, so the on-disk cache stays valid.
+QUERY_ENCODER = os.environ.get("CONTEXTMATCH_QUERY_ENCODER", "float")
+QUERY_MAX_SEQ_LENGTH = 64
+# torch intra-op threads for encoding; 0 keeps torch's default (all cores)
+ENCODER_THREADS = int(os.environ.get("CONTEXTMATCH_ENCODER_THREADS", 0))
+
+_model = None
+_query_model = None
+_entity_embeddings = None
+
+def _set_threads():
+    if ENCODER_THREADS:
+        import torch
+        torch.set_num_threads(ENCODER_THREADS)
+
+def get_model():
+    global _model
+    if _model is None:
+        from sentence_transformers import SentenceTransformer
+        _set_threads()
+        _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+def _load_int8_model():
+    import torch
+    from sentence_transformers import SentenceTransformer
+    _set_threads()
+    model = SentenceTransformer(MODEL_NAME, device="cpu")
+    model.max_seq_length = QUERY_MAX_SEQ_LENGTH
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model
+
+def get_query_model():
+    global _query_model
+    if _query_model is None:
+        if QUERY_ENCODER == "float":
+            _query_model = get_model()
+        elif QUERY_ENCODER == "int8":
+            _query_model = _load_int8_model()
+        else:
+            raise ValueError(f"Unknown QUERY_ENCODER {QUERY_ENCODER!r}, expected 'float' or 'int8'")
+    return _query_model
+
+def _query_encoder_id():
+    """Identifies the query embeddings: cached vectors from another encoder are not reused"""
+    if QUERY_ENCODER == "float":
+        return MODEL_NAME
+    return f"{MODEL_NAME}+{QUERY_ENCODER}@{QUERY_MAX_SEQ_LENGTH}"
+
+def _encode(model, texts):
+    import torch
+    with torch.inference_mode():
+        return model.encode(texts, batch_size=BATCH_SIZE)
+
+def _name_key(name):
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()
+
+def _cache_path(model_name):
+    safe = re.sub(r"[^\w.-]", "_", model_name)
+    return os.path.join(EMBEDDING_CACHE_DIR, safe + ".npz")
+
+def _load_embedding_cache(path):
+    """(keys, matrix) from one .npz file, or ([], None) when missing or inconsistent"""
+    if not os.path.exists(path):
+        return [], None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            keys, matrix = data["keys"].tolist(), data["matrix"]
+    except (OSError, ValueError, KeyError):
+        return [], None
+    if len(keys) != len(matrix):
+        return [], None
+    return keys, matrix
+
+def _save_embedding_cache(path, keys, matrix):
+    """Keys and matrix go into one file, written under a per-process temp name and renamed"""
+    os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=EMBEDDING_CACHE_DIR, suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, keys=np.asarray(keys, dtype="U40"), matrix=matrix)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def encode_names(names, model_name=MODEL_NAME):
+    """
+    Embeddings (float32, one row per name) through the on-disk cache:
+    each distinct name is encoded once, and only names missing from the cache.
+    """
+    path = _cache_path(model_name)
+    cached_keys, cached = _load_embedding_cache(path)
+    key_row = {key: row for row, key in enumerate(cached_keys)}
+
+    keys = [_name_key(name) for name in names]
+    missing = {}
+    for name, key in zip(names, keys):
+        if key not in key_row and key not in missing:
+            missing[key] = name
+    if missing:
+        fresh = np.asarray(get_model().encode(list(missing.values())), dtype=np.float32)
+        cached = fresh if cached is None else np.vstack([cached, fresh])
+        for key in missing:
+            key_row[key] = len(cached_keys)
+            cached_keys.append(key)
+        _save_embedding_cache(path, cached_keys, cached)
+
+    if cached is None:
+        return np.zeros((0, 0), dtype=np.float32)
+    return cached[[key_row[key] for key in keys]]
+
+def _normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+def get_entity_embeddings():
+    """
+    Entity embeddings as one L2-normalized float32 matrix (row i is entity i),
+    so cosine similarity against a normalized query is a single dot product.
+    """
+    global _entity_embeddings
+    if _entity_embeddings is None:
+        _entity_embeddings = _normalize_rows(encode_names(entity_names))
+    return _entity_embeddings
+
+# Nearest-neighbour backend over the entity embeddings (see ann_index): "exact"
+# scans every entity, "ivf" only the closest clusters, e.g. for 1M+ entities.
+# Either way there is one index (shard) per entity type, so a type-filtered
+# search only touches that type's embeddings.
+# ANN_OPTIONS go to the backend, e.g. {"nprobe": 16}; set both before the first search.
+ANN_BACKEND = os.environ.get("CONTEXTMATCH_ANN", "exact")
+ANN_OPTIONS = {}
+# "float16" or "int8" keep the index at 1/2 or ~1/4 of the float32 size; the best
+# top_k * ANN_RESCORE are then re-ranked against a float32 copy memory-mapped
+# from EMBEDDING_CACHE_DIR (0 skips that and ranks on the quantized scores)
+ANN_STORAGE = os.environ.get("CONTEXTMATCH_ANN_STORAGE", "float32")
+ANN_RESCORE = 4
+_entity_index = None
+
+def _rescore_source(matrix):
+    """`matrix` written next to the embedding cache and memory-mapped back read-only"""
+    path = _cache_path(MODEL_NAME)[:-len(".npz")] + ".entities.npy"
+    os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=EMBEDDING_CACHE_DIR, suffix=".npy.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, matrix)
+        # Mapped before the rename: another process replacing `path` meanwhile
+        # cannot hand us its matrix, ours stays reachable through the mapping
+        source = np.load(tmp, mmap_mode="r")
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return source
+
+def get_entity_index():
+    global _entity_index, _entity_embeddings
+    if _entity_index is None:
+        options = dict(ANN_OPTIONS)
+        if ANN_STORAGE != "float32":
+            options.setdefault("storage", ANN_STORAGE)
+            if ANN_RESCORE:
+                options.setdefault("rescore", ANN_RESCORE)
+                # Written in shard order, so each shard maps a contiguous slice
+                order = shard_order(entity_type_codes)
+                options.setdefault("source", _rescore_source(get_entity_embeddings()[order]))
+        _entity_index = ShardedIndex(get_entity_embeddings(), entity_type_codes, ANN_BACKEND, **options)
+        if options.get("storage", "float32") != "float32":
+            # The index holds its own quantized copy; don't keep the float32 one too
+            _entity_embeddings = None
+    return _entity_index
+
+def add_entities(new_entities):
+    """
+    Append entities ({"name", "type"} dicts) to the store, the lookup lists, the
+    embedding cache and the ANN index without rebuilding any of them.
+    """
+    global entity_type_codes, _entity_embeddings
+    new_entities = list(new_entities)
+    if not new_entities:
+        return
+    vectors = _normalize_rows(encode_names([e["name"] for e in new_entities]))
+    for e in new_entities:
+        entity_store.add(e["type"], len(entity_store), e["name"])
+        entities.append(e)
+        entity_names.append(e["name"])
+        entity_names_lower.append(e["name"].lower())
+        entity_names_sorted.append(" ".join(sorted(e["name"].lower().split())))
+        entity_types.append(e["type"])
+        if _entity_vocabulary is not None:
+            _entity_vocabulary.add(e["name"])
+    entity_type_codes = np.asarray(entity_store.cat_codes, dtype=np.intp)
+    # The full matrix is re-read from the embedding cache if asked for again
+    _entity_embeddings = None
+    if _entity_index is not None:
+        _entity_index.add(vectors, entity_type_codes[-len(new_entities):])
+
+def __getattr__(name):
+    # Keep `contextmatch.model` / `contextmatch.entity_embeddings` working, lazily
+    if name == "model":
+        return get_model()
+    if name == "entity_embeddings":
+        return get_entity_embeddings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # -----------------------------
 # 4. Boost calculation
 # -----------------------------
+BOOST_PER_KEYWORD = 0.1
+
+# Every boost_map keyword -> (keyword, types it boosts), built on first use
+_boost_automaton = None
+
+def _get_boost_automaton():
+    global _boost_automaton
+    if _boost_automaton is None:
+        types_by_keyword = {}
+        for entity_type, keywords in boost_map.items():
+            for kw in keywords:
+                types_by_keyword.setdefault(kw, []).append(entity_type)
+        automaton = ahocorasick.Automaton()
+        for kw, types in types_by_keyword.items():
+            automaton.add_word(kw, (kw, types))
+        automaton.make_automaton()
+        _boost_automaton = automaton
+    return _boost_automaton
+
+def keyword_boosts(query):
+    """
+    {entity type: boost} for one query: each boost_map keyword found anywhere in
+    the query adds BOOST_PER_KEYWORD to its types. One Aho-Corasick pass over the
+    query instead of a substring scan per keyword per entity.
+    """
+    boosts = {}
+    automaton = _get_boost_automaton()
+    if len(automaton) == 0:
+        return boosts
+    # A keyword counts once however often it occurs, as with `kw in query`
+    matched = {kw: types for _, (kw, types) in automaton.iter(query.lower())}
+    for types in matched.values():
+        for entity_type in types:
+            boosts[entity_type] = boosts.get(entity_type, 0.0) + BOOST_PER_KEYWORD
+    return boosts
+
+def type_boosts(query):
+    """keyword_boosts() as a vector aligned with entity_store.categories"""
+    boosts = keyword_boosts(query)
+    return np.array([boosts.get(t, 0.0) for t in entity_store.categories])
+
 def calculate_boost(query, entity_type):
-    boost = 0.0
-    q_lower = query.lower()
-    if entity_type in boost_map:
-        for kw in boost_map[entity_type]:
-            if kw in q_lower:
-                boost += 0.1  # boost factor per keyword match
-    return boost
+    return keyword_boosts(query).get(entity_type, 0.0)
 
 # -----------------------------
 # 5. Search function
 # -----------------------------
-def search_entities(query, top_k=5):
-    query_embedding = model.encode(query, convert_to_tensor=True)
-    
-    # Semantic similarity
-    cos_scores = util.cos_sim(query_embedding, entity_embeddings)[0].cpu().numpy()
-    
-    results = []
-    for idx, score in enumerate(cos_scores):
-        entity = entities[idx]
-        boost = calculate_boost(query, entity["type"])
-        final_score = score + boost
-        
-        results.append({
-            "name": entity["name"],
-            "type": entity["type"],
-            "score": final_score
-        })
-    
-    # Sort by score
-    results.sort(key=lambda x: x["score"], reverse=True)
-    
-    # Fuzzy matching fallback
-    fuzz_results = []
-    for e in entities:
-        fuzz_score = fuzz.token_sort_ratio(query.lower(), e["name"].lower()) / 100
-        fuzz_results.append({
-            "name": e["name"],
-            "type": e["type"],
-            "score": fuzz_score
-        })
-    fuzz_results.sort(key=lambda x: x["score"], reverse=True)
-    
-    # Merge (vector first, then fuzzy if missing)
-    seen = set()
-    final = []
-    for r in results:
-        if r["name"] not in seen:
-            final.append(r)
-            seen.add(r["name"])
-    for r in fuzz_results:
-        if r["name"] not in seen:
-            final.append(r)
-            seen.add(r["name"])
-    
-    return final[:top_k]
+# Results per normalized query; invalidated when entity_store.version changes
+search_cache = ResultCache(maxsize=1024)
+# Queries encoded (and scored) together by search_entities_batch()
+BATCH_SIZE = 64
+
+# Normalized query embeddings per normalized query text, so repeated and
+# follow-up questions skip the model; query_cache.stats() gives the hit rate.
+# With CONTEXTMATCH_QUERY_CACHE set to a .npz path the cache is loaded from it
+# on first use and written back at exit.
+QUERY_CACHE_SIZE = int(os.environ.get("CONTEXTMATCH_QUERY_CACHE_SIZE", 10000))
+QUERY_CACHE_PATH = os.environ.get("CONTEXTMATCH_QUERY_CACHE")
+query_cache = ResultCache(maxsize=QUERY_CACHE_SIZE)
+_query_cache_loaded = False
+
+# Case and whitespace folded, once per query: the query_cache and search_cache
+# keys and the tokens fuzzy_entities() sorts all come from it
+SEARCH_NORMALIZER = Normalizer(letters="any")
+
+def _query_key(query):
+    return SEARCH_NORMALIZER(query)[0]
+
+def load_query_cache(path=None):
+    """Add the embeddings saved by save_query_cache() for the current query encoder; returns how many"""
+    path = path or QUERY_CACHE_PATH
+    if not path or not os.path.exists(path):
+        return 0
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data["model"]) != _query_encoder_id():
+                return 0
+            keys, matrix = data["keys"].tolist(), data["matrix"]
+    except (OSError, ValueError, KeyError):
+        return 0
+    # Saved least recently used first, so replaying keeps the LRU order
+    version = _query_encoder_id()
+    for key, vector in zip(keys, matrix):
+        query_cache.put(key, vector, version)
+    return len(keys)
+
+def save_query_cache(path=None):
+    """Write the query cache to `path` (default QUERY_CACHE_PATH), via a temp file and rename"""
+    path = path or QUERY_CACHE_PATH
+    if not path:
+        return
+    items = query_cache.items()
+    if not items or query_cache.version != _query_encoder_id():
+        return
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, model=np.asarray(_query_encoder_id()), keys=np.asarray([key for key, _ in items]),
+                     matrix=np.stack([vector for _, vector in items]))
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def encode_queries(queries, keys=None):
+    """
+    Normalized float32 embeddings of `queries` (one row each) through query_cache;
+    only texts not cached are sent to the model, in one batch.
+    keys: the queries' cache keys (SEARCH_NORMALIZER text) if already computed
+    """
+    global _query_cache_loaded
+    if not _query_cache_loaded:
+        _query_cache_loaded = True
+        if QUERY_CACHE_PATH:
+            load_query_cache()
+            atexit.register(save_query_cache)
+    if keys is None:
+        keys = [_query_key(query) for query in queries]
+    version = _query_encoder_id()
+    vectors = [query_cache.get(key, version) for key in keys]
+    missing = {}  # key -> first query text with that key
+    for query, key, vector in zip(queries, keys, vectors):
+        if vector is None:
+            missing.setdefault(key, query)
+    if missing:
+        fresh = _normalize_rows(_encode(get_query_model(), list(missing.values())))
+        fresh = dict(zip(missing, fresh))
+        for key, vector in fresh.items():
+            query_cache.put(key, vector, version)
+        vectors = [fresh[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack(vectors)
+
+def _type_codes(types):
+    """Category codes of a type name or iterable of names, None for no filter"""
+    if types is None:
+        return None
+    if isinstance(types, str):
+        types = [types]
+    return sorted({entity_store.category_codes[t] for t in types if t in entity_store.category_codes})
+
+def _type_names(codes):
+    """Inverse of _type_codes()"""
+    return None if codes is None else [entity_store.categories[code] for code in codes]
+
+def search_entities(query, top_k=5, types=None):
+    """
+    Best top_k entities for `query`, each {"name", "type", "score"}.
+    types: an entity type or iterable of types to search; None searches all
+    """
+    codes = _type_codes(types)
+    normalized = SEARCH_NORMALIZER(query)
+    cache_key = (normalized[0], top_k, None if codes is None else tuple(codes))
+    version = entity_store.version
+    cached = search_cache.get(cache_key, version)
+    if cached is not None:
+        return [dict(r) for r in cached]
+    results = _search_entities_batch([query], top_k, codes, [normalized])[0]
+    search_cache.put(cache_key, [dict(r) for r in results], version)
+    return results
+
+def search_entities_batch(queries, top_k=5, types=None):
+    """
+    search_entities() for many queries: the ones not in search_cache are
+    encoded in batches of BATCH_SIZE and scored with one matrix product per shard.
+    """
+    codes = _type_codes(types)
+    version = entity_store.version
+    normalized = SEARCH_NORMALIZER.many(queries)
+    keys = [(text, top_k, None if codes is None else tuple(codes)) for text, _ in normalized]
+    out = [search_cache.get(key, version) for key in keys]
+    missing = [i for i, cached in enumerate(out) if cached is None]
+    for start in range(0, len(missing), BATCH_SIZE):
+        chunk = missing[start:start + BATCH_SIZE]
+        found = _search_entities_batch([queries[i] for i in chunk], top_k, codes,
+                                       [normalized[i] for i in chunk])
+        for i, results in zip(chunk, found):
+            search_cache.put(keys[i], [dict(r) for r in results], version)
+            out[i] = results
+    return [[dict(r) for r in results] for results in out]
+
+def _search_entities(query, top_k=5, codes=None):
+    return _search_entities_batch([query], top_k, codes)[0]
+
+def _search_entities_batch(queries, top_k=5, codes=None, normalized=None):
+    """normalized: SEARCH_NORMALIZER (text, tokens) per query if the caller has them"""
+    if normalized is None:
+        normalized = SEARCH_NORMALIZER.many(queries)
+    embeddings = encode_queries(queries, [text for text, _ in normalized])
+    index = get_entity_index()
+    boosts = np.array([type_boosts(text) for text, _ in normalized])
+    found = index.search_batch(embeddings, top_k, boosts, only=codes)
+    return [_entity_results(index, query, tokens, embedding, query_boosts, rows, scores, top_k, codes)
+            for query, (_, tokens), embedding, query_boosts, (rows, scores)
+            in zip(queries, normalized, embeddings, boosts, found)]
+
+def _entity_results(index, query, tokens, embedding, boosts, rows, scores, top_k, codes):
+    # Semantic similarity plus the keyword boost of each entity's type; only the
+    # best rows become dicts, the cut widens while duplicate names leave fewer than top_k
+    want = top_k
+    while True:
+        results, seen = [], set()
+        for row, score in zip(rows.tolist(), scores.tolist()):
+            if entity_names[row] not in seen:
+                seen.add(entity_names[row])
+                results.append({"name": entity_names[row], "type": entity_types[row], "score": score})
+        if len(results) >= top_k or len(rows) < want:
+            break
+        want *= 2
+        rows, scores = index.search(embedding, want, boosts, only=codes)
+
+    # Fuzzy matching fallback, only needed when there are fewer than top_k distinct names
+    if len(results) < top_k:
+        results += fuzzy_entities(query, top_k - len(results), exclude={r["name"] for r in results},
+                                  types=_type_names(codes), tokens=tokens)
+    return results[:top_k]
+
+def fuzzy_entities(query, top_k=5, exclude=(), score_cutoff=None, workers=-1, types=None, tokens=None):
+    """
+    Best entities by fuzz.token_sort_ratio (score 0-1), distinct names not in
+    `exclude`, optionally only of `types`. One multi-threaded cdist over the
+    pre-sorted names scores every candidate; only the selected rows become dicts.
+    tokens: SEARCH_NORMALIZER tokens of `query` if already computed
+    """
+    codes = _type_codes(types)
+    if codes is None:
+        candidates = np.arange(len(entity_names_sorted))
+        choices = entity_names_sorted
+    else:
+        candidates = np.flatnonzero(np.isin(entity_type_codes, codes))
+        choices = [entity_names_sorted[row] for row in candidates.tolist()]
+    if tokens is None:
+        tokens = SEARCH_NORMALIZER(query)[1]
+    query_sorted = " ".join(sorted(tokens))
+    scores = process.cdist([query_sorted], choices, scorer=fuzz.ratio,
+                           score_cutoff=score_cutoff, dtype=np.float64, workers=workers)[0]
+    want = top_k + len(exclude)
+    while True:
+        best = top_rows(scores, want)
+        rows = candidates[best]
+        results, seen = [], set(exclude)
+        for row, score in zip(rows.tolist(), scores[best].tolist()):
+            if score_cutoff is not None and score < score_cutoff:
+                break
+            if entity_names[row] not in seen:
+                seen.add(entity_names[row])
+                results.append({"name": entity_names[row], "type": entity_types[row],
+                                "score": score / 100})
+        if len(results) >= top_k or len(rows) == len(scores):
+            return results[:top_k]
+        want *= 2
 
 # -----------------------------
 # 6. Prompt builder for LLM
 # -----------------------------
 def build_context_prompt(query):
-    matched_entities = search_entities(query, top_k=10)
+    return _context_prompt(query, search_entities(query, top_k=10))
+
+def build_context_prompts(queries):
+    """build_context_prompt() for many queries, searched with search_entities_batch()"""
+    return [_context_prompt(query, matched)
+            for query, matched in zip(queries, search_entities_batch(queries, top_k=10))]
+
+def _context_prompt(query, matched_entities):
     context_lines = [f"{e['name']} ({e['type']})" for e in matched_entities]
     return (
         f"Known Entities in this company:\n" +
@@ -3243,53 +3690,87 @@ def build_context_prompt(query):
     )
 
 # --- Build dynamic stopwords ---
+# Common filler words in user queries; those that occur in a master name are kept
+GENERIC_STOPWORDS = {
+    "what", "whats", "is", "are", "the", "to", "of", "in", "for", "last", "this", "that",
+    "trend", "sales", "sale", "purchases", "purchase", "quarter", "month", "monthly",
+    "weekly", "daily", "did", "we", "do", "how", "much", "my", "our", "on", "at"
+}
+
+_entity_vocabulary = None
+
 def build_stopwords(master_data):
-    # Take all unique words from master names
-    master_vocab = set()
-    for entry in master_data:
-        for word in re.findall(r'\b\w+\b', entry["name"].lower()):
-            master_vocab.add(word)
-
-    # Common filler words in user queries
-    generic_stopwords = {
-        "what", "whats", "is", "are", "the", "to", "of", "in", "for", "last", "this", "that",
-        "trend", "sales", "sale", "purchases", "purchase", "quarter", "month", "monthly",
-        "weekly", "daily", "did", "we", "do", "how", "much", "my", "our", "on", "at"
-    }
-
-    # Only keep words that are NOT in master vocab
-    stopwords = {w for w in generic_stopwords if w not in master_vocab}
-    return stopwords
+    return Vocabulary.from_names((entry["name"] for entry in master_data), GENERIC_STOPWORDS).stop_words
+
+def get_entity_vocabulary():
+    """Vocabulary of the entity names, kept current by add_entities(); .stop_words for clean_query()"""
+    global _entity_vocabulary
+    if _entity_vocabulary is None:
+        _entity_vocabulary = Vocabulary.from_names(entity_names, GENERIC_STOPWORDS)
+    return _entity_vocabulary
 
 # --- Abbreviation expansion ---
+ABBREVIATIONS = {
+    "mfg": "manufacturing",
+    "pvt": "private",
+    "ltd": "limited",
+    "co": "company",
+    "corp": "corporation",
+    "intl": "international",
+}
+
 def expand_abbreviations(text):
-    abbr_map = {
-        "mfg": "manufacturing",
-        "pvt": "private",
-        "ltd": "limited",
-        "co": "company",
-        "corp": "corporation",
-        "intl": "international",
-    }
     words = text.split()
-    expanded_words = [abbr_map.get(w, w) for w in words]
+    expanded_words = [ABBREVIATIONS.get(w, w) for w in words]
     return " ".join(expanded_words)
 
 # --- Clean query ---
+# Lower-cased, punctuation dropped (unicode letters kept), abbreviations expanded
+QUERY_NORMALIZER = Normalizer(letters="word", punctuation="", abbreviations=ABBREVIATIONS)
+
 def clean_query(query, stopwords):
-    query = query.lower()
-    query = re.sub(r"[^\w\s]", "", query)  # remove punctuation
-    query = expand_abbreviations(query)
-    words = query.split()
-    words = [w for w in words if w not in stopwords]
-    return " ".join(words)
+    return QUERY_NORMALIZER.replace(stop_words=stopwords)(query)[0]
+
+def clean_queries(queries, stopwords):
+    """clean_query() for many queries"""
+    return [text for text, _ in QUERY_NORMALIZER.replace(stop_words=stopwords).many(queries)]
+
+# -----------------------------
+# 7. Query encoder benchmark
+# -----------------------------
+def benchmark_query_encoder(queries, top_k=10):
+    """
+    The int8 query encoder against the float model on `queries`: encode latency
+    one query at a time (ms percentiles) and as one batch (s), the share of the
+    float model's top_k entities the int8 embeddings also find, and the lowest
+    cosine similarity between the two embeddings of a query.
+    """
+    index = get_entity_index()
+    stats, embeddings, found = {}, {}, {}
+    for name, model in (("float", get_model()), ("int8", _load_int8_model())):
+        _encode(model, queries[:8])  # warm-up
+        times = []
+        for query in queries:
+            started = time.perf_counter()
+            _encode(model, [query])
+            times.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        embeddings[name] = _normalize_rows(_encode(model, queries))
+        batch_s = time.perf_counter() - started
+        found[name] = [set(rows.tolist()) for rows, _ in index.search_batch(embeddings[name], top_k)]
+        stats[name] = {"p50_ms": float(np.percentile(times, 50)),
+                       "p99_ms": float(np.percentile(times, 99)), "batch_s": batch_s}
+    stats["agreement"] = float(np.mean([len(f & q) / max(len(f), 1)
+                                        for f, q in zip(found["float"], found["int8"])]))
+    stats["min_cosine"] = float((embeddings["float"] * embeddings["int8"]).sum(axis=1).min())
+    return stats
 
 # -----------------------------
-# 7. Example
+# 8. Example: python contextmatch.py [--benchmark-encoder]
 # -----------------------------
 if __name__ == "__main__":
     # user_query = "Did we cross 10 lakhs in sales for Accord Soft?"
-    stopwords = build_stopwords(entities)
+    stopwords = get_entity_vocabulary().stop_words
 
     # Example queries
     queries = [
@@ -3455,10 +3936,16 @@ if __name__ == "__main__":
         'Assign a ledger to Fixed Asset group?',
     ]
 
-    print('checking queries')
-    for q in queries:
-        print(f"\nQuery: {q}")
-        cleaned_entity = clean_query(q["name"], stopwords)
-        print(build_context_prompt(q))
+    if "--benchmark-encoder" in sys.argv:
+        stats = benchmark_query_encoder(queries)
+        for name in ("float", "int8"):
+            print(f"{name:5s}  p50={stats[name]['p50_ms']:.1f}ms  p99={stats[name]['p99_ms']:.1f}ms  "
+                  f"batch of {len(queries)}={stats[name]['batch_s']:.2f}s")
+        print(f"top-10 agreement={stats['agreement']:.3f}  min cosine={stats['min_cosine']:.4f}")
+    else:
+        print('checking queries')
+        for q, prompt in zip(queries, build_context_prompts(queries)):
+            print(f"\nQuery: {q}")
+            print(prompt)
 
     
@@ -0,0 +1,369 @@
+import os
+import json
+import itertools
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+# On-disk layout written by MasterStore.save(), bump when a file changes shape
+STORE_VERSION = 2
+STORE_MANIFEST = "manifest.json"
+
+_stamps = itertools.count()  # MasterStore.stamp, never reused within a process
+
+
+def replace_file(path, write):
+    """
+    write(f) into a temporary file next to `path`, then rename it over `path`.
+    A process that has the old file memory-mapped keeps reading the old inode
+    instead of a file truncated under it (SIGBUS).
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class StringColumn:
+    def __init__(self, buffer=None, starts=None, lengths=None, intern=False):
+        """
+        Strings packed into one utf-8 buffer, addressed by (start, length) per row.
+        intern: identical values appended share one slice of the buffer, for
+            bulk builds; freeze() turns it off so later appends are stored once
+        """
+        self.buffer = bytearray() if buffer is None else buffer
+        self.starts = array("q") if starts is None else starts
+        self.lengths = array("i") if lengths is None else lengths
+        self._interned = {} if intern else None  # bytes -> start, only kept while building
+
+    def append(self, text):
+        data = text.encode("utf-8")
+        start = None if self._interned is None else self._interned.get(data)
+        if start is None:
+            start = len(self.buffer)
+            self.buffer += data
+            if self._interned is not None:
+                self._interned[data] = start
+        self.starts.append(start)
+        self.lengths.append(len(data))
+
+    def freeze(self):
+        """Drop the interning table once the bulk build is done; later appends are not interned"""
+        self._interned = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, row):
+        start = int(self.starts[row])
+        return bytes(self.buffer[start:start + int(self.lengths[row])]).decode("utf-8")
+
+    def decode(self, rows):
+        """Decode many rows at once; much cheaper than indexing a memory-mapped column row by row"""
+        data = bytes(self.buffer)
+        starts = self.starts.tolist()
+        lengths = self.lengths.tolist()
+        return [data[starts[row]:starts[row] + lengths[row]].decode("utf-8") for row in rows]
+
+    def save(self, path):
+        replace_file(path + ".bin", lambda f: f.write(bytes(self.buffer)))
+        replace_file(path + ".start.npy", lambda f: np.save(f, np.asarray(self.starts, dtype=np.int64)))
+        replace_file(path + ".len.npy", lambda f: np.save(f, np.asarray(self.lengths, dtype=np.int32)))
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a column written by save()"""
+        if os.path.getsize(path + ".bin") == 0:
+            buffer = b""
+        else:
+            buffer = np.memmap(path + ".bin", dtype=np.uint8, mode="r")
+        return cls(
+            buffer,
+            np.load(path + ".start.npy", mmap_mode="r"),
+            np.load(path + ".len.npy", mmap_mode="r"),
+        )
+
+
+class MasterStore:
+    def __init__(self, intern=False):
+        """
+        Columnar master table, one row per master:
+            ids          master id per row
+            cat_codes    category code per row (index into categories)
+            names        original names
+            names_lower  normalized names used for matching
+        Rows are addressed by position; row() resolves (category, master_id) by
+        binary search over per-category sorted id arrays, plus a dict for rows
+        added after those arrays were built.
+        A store returned by load() is memory-mapped; the first add() copies it
+        into process memory.
+        intern: share the bytes of repeated names until freeze(), for bulk builds
+        """
+        self.categories = []
+        self.category_codes = {}
+        self.ids = array("q")
+        self.cat_codes = array("i")
+        self.names = StringColumn(intern=intern)
+        self.names_lower = StringColumn(intern=intern)
+        self.rows_by_category = {}  # category -> array of rows, in insertion order
+        self._row_index = None      # category -> (sorted ids, rows), built on first lookup
+        self._added_rows = {}       # (category, master_id) -> row added since _row_index was built
+        self._names_lower_cache = {}
+        self.deleted = frozenset()  # tombstoned rows, dropped by compacted(); replaced, never mutated
+        self.version = 0            # bumped by every add() / remove()
+        self.stamp = next(_stamps)  # tells stores apart in caches, unlike id() which is reused
+
+    # ---------------------------
+    # Building
+    # ---------------------------
+    @classmethod
+    def from_dict(cls, masters_dict, normalize=str.lower):
+        """masters_dict: {"Ledger": [(id, name), ...], ...}"""
+        store = cls(intern=True)
+        for cat, items in masters_dict.items():
+            store._category_code(cat)
+            for mid, name in items:
+                store.add(cat, mid, name, normalize(name))
+        store.freeze()
+        return store
+
+    @classmethod
+    def from_records(cls, records, normalize=str.lower):
+        """records: iterable of (category, id, name)"""
+        store = cls(intern=True)
+        for cat, mid, name in records:
+            store.add(cat, mid, name, normalize(name))
+        store.freeze()
+        return store
+
+    @classmethod
+    def concat(cls, parts):
+        """Stack stores built independently (e.g. one per table) into one; rows keep their order"""
+        store = cls()
+        for part in parts:
+            offset = len(store)
+            codes = [store._category_code(cat) for cat in part.categories]
+            store.ids.extend(part.ids)
+            store.cat_codes.extend(codes[code] for code in part.cat_codes)
+            for cat in part.categories:
+                store.rows_by_category[cat].extend(row + offset for row in part.category_rows(cat))
+            for column, other in ((store.names, part.names), (store.names_lower, part.names_lower)):
+                base = len(column.buffer)
+                column.buffer += other.buffer
+                column.starts.extend(start + base for start in other.starts)
+                column.lengths.extend(other.lengths)
+            store.deleted = store.deleted.union(row + offset for row in part.deleted)
+        return store
+
+    def _category_code(self, category):
+        code = self.category_codes.get(category)
+        if code is None:
+            code = len(self.categories)
+            self.categories.append(category)
+            self.category_codes[category] = code
+            self.rows_by_category[category] = array("q")
+        return code
+
+    def add(self, category, master_id, name, name_lower=None):
+        """Append one master and return its row"""
+        self.ensure_writable()
+        name_lower = name.lower() if name_lower is None else name_lower
+        row = len(self.ids)
+        self.ids.append(master_id)
+        self.cat_codes.append(self._category_code(category))
+        self.names.append(name)
+        self.names_lower.append(name_lower)
+        self.rows_by_category[category].append(row)
+        if self._row_index is not None:
+            self._added_rows[(category, master_id)] = row
+        if category in self._names_lower_cache:
+            self._names_lower_cache[category].append(name_lower)
+        self.version += 1
+        return row
+
+    def remove(self, row):
+        """
+        Tombstone a row; it keeps its position until compacted(). The tombstone
+        set is swapped for a new one, so a reader holding the old set keeps a
+        consistent snapshot.
+        """
+        self.deleted = self.deleted | {row}
+        self.version += 1
+
+    def is_live(self, row):
+        return row not in self.deleted
+
+    def deleted_positions(self, category, deleted=None):
+        """
+        Positions within category_rows(category) that are tombstoned, or None.
+        deleted: tombstone snapshot to use instead of the current one
+        """
+        deleted = self.deleted if deleted is None else deleted
+        if not deleted:
+            return None
+        # bisect rather than a numpy view: an exported buffer would block add() in another thread
+        rows = self.category_rows(category)
+        code = self.category_codes.get(category)
+        return np.array(sorted(bisect_left(rows, row) for row in deleted
+                               if self.cat_codes[row] == code), dtype=np.int64)
+
+    def compacted(self, upto=None, deleted=None):
+        """
+        New store holding only live rows, in the same order.
+        upto / deleted: row count and tombstones to use instead of the current ones
+        """
+        upto = len(self) if upto is None else upto
+        deleted = self.deleted if deleted is None else deleted
+        store = MasterStore(intern=True)
+        for cat in self.categories:
+            store._category_code(cat)
+            for row in list(self.category_rows(cat)):
+                if row < upto and row not in deleted:
+                    store.add(cat, self.master_id(row), self.names[row], self.names_lower[row])
+        store.freeze()
+        return store
+
+    def ensure_writable(self):
+        """Copy memory-mapped columns into growable arrays before the first add()"""
+        if isinstance(self.ids, np.ndarray):
+            self.ids = array("q", np.asarray(self.ids).tolist())
+            self.cat_codes = array("i", np.asarray(self.cat_codes).tolist())
+            for column in (self.names, self.names_lower):
+                column.buffer = bytearray(column.buffer)
+                column.starts = array("q", np.asarray(column.starts).tolist())
+                column.lengths = array("i", np.asarray(column.lengths).tolist())
+
+    def freeze(self):
+        self.names.freeze()
+        self.names_lower.freeze()
+
+    # ---------------------------
+    # Lookups
+    # ---------------------------
+    def __len__(self):
+        return len(self.ids)
+
+    def _build_row_index(self):
+        # ~12 bytes per master, where a (category, id) -> row dict took ~170
+        ids = np.array(self.ids.tolist(), dtype=np.int64)
+        row_index = {}
+        for cat in self.categories:
+            rows = np.array(self.category_rows(cat).tolist(), dtype=np.int64)
+            order = np.argsort(ids[rows], kind="stable")
+            row_index[cat] = (ids[rows][order], rows[order].astype(np.int32))
+        self._added_rows = {}
+        self._row_index = row_index
+
+    def row(self, category, master_id):
+        """Row of (category, master_id), or None if unknown or removed"""
+        if self._row_index is None:
+            self._build_row_index()
+        row = self._added_rows.get((category, master_id))
+        if row is None and category in self._row_index:
+            ids, rows = self._row_index[category]
+            # Last match: a re-added id sits after its tombstoned predecessor
+            i = int(np.searchsorted(ids, master_id, side="right")) - 1
+            if i >= 0 and ids[i] == master_id:
+                row = int(rows[i])
+        if row is None or row in self.deleted:
+            return None
+        return row
+
+    def master_id(self, row):
+        return int(self.ids[row])
+
+    def category(self, row):
+        return self.categories[self.cat_codes[row]]
+
+    def name(self, row):
+        return self.names[row]
+
+    def name_lower(self, row):
+        return self.names_lower[row]
+
+    def category_rows(self, category):
+        return self.rows_by_category.get(category, ())
+
+    def category_names_lower(self, category):
+        """
+        Normalized names of one category as a list, in category_rows() order.
+
+        RapidFuzz only scores str sequences, so these are decoded once and cached.
+        That roughly doubles the store's footprint (on 100k synthetic masters:
+        ~79 bytes per master for the columns, ~75 more for the decoded list),
+        but decoding a 30k-name category costs ~25 ms, several times the
+        fuzzy scoring it feeds, so it is not redone per query.
+        """
+        names = self._names_lower_cache.get(category)
+        if names is None:
+            names = self.names_lower.decode(self.category_rows(category))
+            self._names_lower_cache[category] = names
+        return names
+
+    def to_dict(self):
+        """Inverse of from_dict(), live rows only"""
+        return {
+            cat: [(self.master_id(row), self.names[row])
+                  for row in self.category_rows(cat) if row not in self.deleted]
+            for cat in self.categories
+        }
+
+    # ---------------------------
+    # Persistence
+    # ---------------------------
+    def save(self, path):
+        """
+        Write live rows the store to directory `path`:
+            manifest.json            version, categories, row count
+            ids.npy / cats.npy       id and category code per row
+            names.* / lower.*        string columns (utf-8 .bin + .start.npy/.len.npy)
+        Everything is memory-mapped by load(), so processes share the pages;
+        every file is replaced rather than rewritten, so processes still mapping
+        an older save keep a consistent view of it.
+        """
+        if self.deleted:
+            self.compacted().save(path)
+            return
+        os.makedirs(path, exist_ok=True)
+        replace_file(os.path.join(path, "ids.npy"), lambda f: np.save(f, np.asarray(self.ids, dtype=np.int64)))
+        replace_file(os.path.join(path, "cats.npy"), lambda f: np.save(f, np.asarray(self.cat_codes, dtype=np.int32)))
+        self.names.save(os.path.join(path, "names"))
+        self.names_lower.save(os.path.join(path, "lower"))
+
+        # Manifest goes last so a half-written store is never picked up
+        manifest = {"version": STORE_VERSION, "categories": self.categories, "count": len(self)}
+        replace_file(os.path.join(path, STORE_MANIFEST), lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, STORE_MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != STORE_VERSION:
+            raise ValueError(
+                f"Unsupported store version {manifest.get('version')} in {path} "
+                f"(expected {STORE_VERSION})"
+            )
+
+        store = cls()
+        store.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        store.cat_codes = np.load(os.path.join(path, "cats.npy"), mmap_mode="r")
+        store.names = StringColumn.load(os.path.join(path, "names"))
+        store.names_lower = StringColumn.load(os.path.join(path, "lower"))
+        if not (len(store.ids) == len(store.cat_codes) == len(store.names)
+                == len(store.names_lower) == manifest["count"]):
+            raise ValueError(f"Corrupt store in {path}: column sizes do not match manifest")
+
+        store.categories = list(manifest["categories"])
+        store.category_codes = {cat: code for code, cat in enumerate(store.categories)}
+        codes = np.asarray(store.cat_codes)
+        store.rows_by_category = {
+            cat: array("q", np.flatnonzero(codes == code).tolist())
+            for code, cat in enumerate(store.categories)
+        }
+        return store
@@ -0,0 +1,322 @@
+import time
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pymysql
+import pymysql.cursors
+
+from master_store import MasterStore
+
+# ---------------------------------------
+# Master tables and the matcher category each one feeds
+# (same tables / categories as HybridMasterMatcher.get_db_data)
+# ---------------------------------------
+MASTER_TABLES = [
+    ("ledger_groups", "Groups"),
+    ("ledgers", "Ledgers"),
+    ("stock_items", "Stock"),
+    ("stock_item_categories", "Stock_Categories"),
+    ("stock_item_groups", "Stock_Groups"),
+    ("cost_centres", "Cost_Center"),
+]
+
+
+def _placeholder(conn):
+    raw = getattr(conn, "raw", conn)
+    return "?" if isinstance(raw, sqlite3.Connection) else "%s"
+
+
+def _columns(updated_column, deleted_column):
+    """Selected columns: id, name, then the optional updated / deleted ones"""
+    return ["id", "name"] + [column for column in (updated_column, deleted_column) if column]
+
+
+def _advance_watermark(watermark, mid, updated):
+    """(max id, max updated) once one more row has been seen"""
+    max_id, max_updated = watermark
+    if max_id is None or mid > max_id:
+        max_id = mid
+    if updated is not None and (max_updated is None or updated > max_updated):
+        max_updated = updated
+    return max_id, max_updated
+
+
+def _streaming_cursor(conn):
+    """Server-side (unbuffered) cursor for pymysql, plain cursor elsewhere"""
+    raw = getattr(conn, "raw", conn)
+    if isinstance(raw, pymysql.connections.Connection):
+        return raw.cursor(pymysql.cursors.SSCursor)
+    return raw.cursor()
+
+
+class _PooledConnection:
+    """Connection proxy whose close() hands the connection back to the pool"""
+    def __init__(self, pool, raw):
+        self.pool = pool
+        self.raw = raw
+
+    def __getattr__(self, attr):
+        return getattr(self.raw, attr)
+
+    def close(self):
+        if self.raw is not None:
+            self.pool.release(self.raw)
+            self.raw = None
+
+    def discard(self):
+        """Close the connection for good, e.g. after a failed read left results pending"""
+        if self.raw is not None:
+            self.pool.discard(self.raw)
+            self.raw = None
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=6):
+        """
+        connect: callable opening a new DB-API connection
+        size: max connections open at once; connect() blocks when all are in use
+        """
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        self._slots.acquire()
+        try:
+            raw = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                raw = self._connect()
+            except BaseException:
+                self._slots.release()
+                raise
+        return _PooledConnection(self, raw)
+
+    def release(self, raw):
+        self._idle.put(raw)
+        self._slots.release()
+
+    def discard(self, raw):
+        """Drop a broken connection instead of returning it to the idle list"""
+        try:
+            raw.close()
+        except Exception:
+            pass
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class MasterLoader:
+    def __init__(self, pool, company_id=1, tables=MASTER_TABLES, fetch_size=5000,
+                 updated_column=None, deleted_column=None):
+        """
+        Full load of the master tables, one pooled connection per table in parallel.
+        Rows are streamed from a server-side cursor in fetch_size batches straight
+        into a per-table MasterStore, so no list of tuples is materialized.
+
+        pool: ConnectionPool, or any callable opening a DB-API connection
+        updated_column / deleted_column: as in MasterSync; soft-deleted rows are
+            skipped, and fetch() leaves the (max id, max updated) of every table,
+            deleted rows included, in `watermarks` for MasterSync.refresh()
+        """
+        self.connect = pool.connect if isinstance(pool, ConnectionPool) else pool
+        self.company_id = company_id
+        self.tables = list(tables)
+        self.fetch_size = fetch_size
+        self.updated_column = updated_column
+        self.deleted_column = deleted_column
+        self.watermarks = {}  # table -> (max_id, max_updated), set by fetch()
+
+    def _load_table(self, table, category):
+        fetch_s = build_s = 0.0
+        part = MasterStore(intern=True)
+        part._category_code(category)
+        watermark = (None, None)
+        updated_at = 2 if self.updated_column else None
+        deleted_at = -1 if self.deleted_column else None
+        conn = self.connect()
+        try:
+            cursor = _streaming_cursor(conn)
+            started = time.perf_counter()
+            columns = ", ".join(_columns(self.updated_column, self.deleted_column))
+            cursor.execute(f"SELECT {columns} FROM {table} WHERE company_id = {_placeholder(conn)}",
+                           [self.company_id])
+            fetch_s += time.perf_counter() - started
+            while True:
+                started = time.perf_counter()
+                batch = cursor.fetchmany(self.fetch_size)
+                fetch_s += time.perf_counter() - started
+                if not batch:
+                    break
+                started = time.perf_counter()
+                for row in batch:
+                    mid, name = row[0], row[1]
+                    watermark = _advance_watermark(watermark, mid, None if updated_at is None else row[updated_at])
+                    if deleted_at is None or not row[deleted_at]:
+                        part.add(category, mid, name, name.lower())
+                build_s += time.perf_counter() - started
+            cursor.close()
+        except BaseException:
+            # An unbuffered cursor stopped mid-result leaves the connection out of sync
+            getattr(conn, "discard", conn.close)()
+            raise
+        conn.close()
+        part.freeze()
+        return part, watermark, {"rows": len(part), "fetch_s": fetch_s, "build_s": build_s}
+
+    def fetch(self):
+        """
+        Fetch all tables concurrently into one MasterStore and set `watermarks`.
+        Returns (store, timings) with timings {table: {"rows", "fetch_s", "build_s"}}
+        """
+        with ThreadPoolExecutor(max_workers=len(self.tables)) as executor:
+            futures = [executor.submit(self._load_table, table, category) for table, category in self.tables]
+            results = [future.result() for future in futures]
+
+        timings = {}
+        watermarks = {}
+        for (table, _), (_, watermark, stats) in zip(self.tables, results):
+            timings[table] = stats
+            watermarks[table] = watermark
+        self.watermarks = watermarks
+        return MasterStore.concat([part for part, _, _ in results]), timings
+
+    def load(self, matcher):
+        """
+        fetch() and install the result in `matcher`.
+        Returns timings: {table: {"rows", "fetch_s", "build_s"}, "index_s": automaton + trigram build}
+        """
+        store, timings = self.fetch()
+        started = time.perf_counter()
+        matcher.load_store(store)
+        timings["index_s"] = time.perf_counter() - started
+        return timings
+
+
+class MasterSync:
+    def __init__(self, connect, company_id=1, tables=MASTER_TABLES,
+                 updated_column="updated_at", deleted_column=None, fetch_size=5000):
+        """
+        Delta sync of master tables into a live HybridMasterMatcher.
+
+        connect: callable returning a DB-API connection (pymysql or sqlite3),
+            e.g. ConnectionPool.connect
+        updated_column: per-row modification timestamp; None tracks new ids only,
+            so renames are picked up only by a full load()
+        deleted_column: soft-delete flag/timestamp; non-empty values remove the master
+        fetch_size: rows per batch streamed by the full load (see MasterLoader)
+
+        A high-water mark (max id, max updated_column) is kept per table and each
+        refresh() only fetches rows beyond it.
+        """
+        self.connect = connect
+        self.company_id = company_id
+        self.tables = list(tables)
+        self.updated_column = updated_column
+        self.deleted_column = deleted_column
+        self.fetch_size = fetch_size
+        self.watermarks = {}  # table -> (max_id, max_updated)
+
+    def _select(self, table, placeholder, delta):
+        columns = _columns(self.updated_column, self.deleted_column)
+        sql = f"SELECT {', '.join(columns)} FROM {table} WHERE company_id = {placeholder}"
+        params = [self.company_id]
+        if delta:
+            max_id, max_updated = self.watermarks.get(table, (None, None))
+            conditions = []
+            if max_id is not None:
+                conditions.append(f"id > {placeholder}")
+                params.append(max_id)
+            if self.updated_column and max_updated is not None:
+                # >= because rows written in the same tick may land after our read;
+                # re-applying an unchanged row is a no-op
+                conditions.append(f"{self.updated_column} >= {placeholder}")
+                params.append(max_updated)
+            if conditions:
+                sql += " AND (" + " OR ".join(conditions) + ")"
+        return sql, params
+
+    def _fetch(self, delta):
+        """
+        Yield (table, category, rows) with rows as (id, name, updated, deleted).
+        Watermarks are left alone; callers _advance() once the rows are applied.
+        """
+        conn = self.connect()
+        placeholder = _placeholder(conn)
+        try:
+            cursor = conn.cursor()
+            for table, category in self.tables:
+                sql, params = self._select(table, placeholder, delta)
+                cursor.execute(sql, params)
+                rows = []
+                for row in cursor.fetchall():
+                    updated = row[2] if self.updated_column else None
+                    deleted = row[-1] if self.deleted_column else None
+                    rows.append((row[0], row[1], updated, deleted))
+                yield table, category, rows
+            cursor.close()
+        finally:
+            conn.close()
+
+    def _advance(self, table, rows):
+        watermark = self.watermarks.get(table, (None, None))
+        for mid, _, updated, _ in rows:
+            watermark = _advance_watermark(watermark, mid, updated)
+        self.watermarks[table] = watermark
+
+    def load(self, matcher):
+        """
+        Full load through MasterLoader (tables fetched in parallel and streamed,
+        soft-deleted rows skipped), then reset the watermarks to what it read.
+        Returns the loader's timings.
+        """
+        loader = MasterLoader(self.connect, self.company_id, self.tables, self.fetch_size,
+                              self.updated_column, self.deleted_column)
+        timings = loader.load(matcher)
+        # Only a matcher that actually holds these rows may skip them next refresh()
+        self.watermarks = dict(loader.watermarks)
+        return timings
+
+    def refresh(self, matcher):
+        """
+        Fetch rows changed since the last load()/refresh() and apply them through
+        add_master / rename_master / remove_master.
+        Returns counts of {"added", "renamed", "removed"}.
+        """
+        stats = {"added": 0, "renamed": 0, "removed": 0}
+        for table, category, rows in self._fetch(delta=True):
+            for mid, name, _, deleted in rows:
+                row = matcher.store.row(category, mid)
+                if deleted:
+                    if row is not None:
+                        matcher.remove_master(category, mid)
+                        stats["removed"] += 1
+                elif row is None:
+                    matcher.add_master(category, mid, name)
+                    stats["added"] += 1
+                elif matcher.store.name(row) != name:
+                    matcher.rename_master(category, mid, name)
+                    stats["renamed"] += 1
+            # A failure above leaves the watermark behind, so the table is re-read
+            self._advance(table, rows)
+        return stats
+
+
+def create_sqlite_schema(conn, tables=MASTER_TABLES):
+    """Minimal offline stand-in for the master tables, for exercising MasterSync with sqlite3"""
+    for table, _ in tables:
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "id INTEGER PRIMARY KEY, company_id INTEGER NOT NULL, name TEXT NOT NULL, "
+            "updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP, deleted_at TEXT)"
+        )
+    conn.commit()
@@ -1,7 +1,9 @@
-import re
 from collections import defaultdict
 from rapidfuzz import fuzz
 import ahocorasick
+from normalizer import Normalizer
+from trigram_index import TrigramIndex
+from substring_index import SubstringIndex
 
 # ---------------------------
 # 1. Keyword dictionary
@@ -20,76 +22,134 @@ abbreviations = {
 }
 
 # ---------------------------
-# 2. Build Aho-Corasick Automaton for exact matches
+# 2. Keyword classifier
 # ---------------------------
-A = ahocorasick.Automaton()
-keyword_to_category = {}
-
-for category, words in keywords.items():
-    for word in words:
-        word_lower = word.lower()
-        A.add_word(word_lower, (word_lower, category))
-        keyword_to_category[word_lower] = category
-
-A.make_automaton()
-
-# ---------------------------
-# 3. Preprocessing helper
-# ---------------------------
-def preprocess(text):
-    text = text.lower()
-    text = re.sub(r'[^a-z0-9\s]', '', text)
-    tokens = text.split()
-    # Expand known abbreviations
-    expanded_tokens = [abbreviations.get(tok, tok) for tok in tokens]
-    return " ".join(expanded_tokens), expanded_tokens
-
-# ---------------------------
-# 4. Enhanced Matching Function
-# ---------------------------
-def match_keywords(sentence, fuzzy_threshold=85):
-    text, tokens = preprocess(sentence)
-
-    matches = defaultdict(list)
-    scores = defaultdict(float)
-
-    # Step 1: Exact & multi-word match via Aho-Corasick
-    for end_idx, (kw, category) in A.iter(text):
-        matches[category].append((kw, 100))
-        scores[category] += 1.0
-
-    # Step 2: Fuzzy matching for spelling mistakes & partial matches
-    for token in tokens:
-        for kw, category in keyword_to_category.items():
-            score = fuzz.ratio(token, kw)
-            if score >= fuzzy_threshold:
+class KeywordClassifier:
+    def __init__(self, keywords, abbreviations=None, fuzzy_threshold=85):
+        """
+        keywords: {category: [keyword, ...]}; a keyword listed under several
+            categories counts for the last one
+        Built once, then classify() scores text against every keyword through:
+            automaton        exact and multi-word keyword hits (Aho-Corasick)
+            trigram_index    lossless fuzz.ratio shortlist per token (see TrigramIndex.candidates)
+            substring_index  keywords containing a token (suffix array, see SubstringIndex)
+        so the cost per token follows the keywords that can match, not all of them.
+        """
+        self.keywords = keywords
+        self.fuzzy_threshold = fuzzy_threshold
+        self.normalizer = Normalizer(punctuation="", abbreviations=abbreviations)
+        self.sizes = {category: len(words) for category, words in keywords.items()}
+
+        category_of = {}
+        for category, words in keywords.items():
+            for word in words:
+                category_of[word.lower()] = category
+        self.names = list(category_of)
+        self.categories = list(category_of.values())
+
+        self.automaton = ahocorasick.Automaton()
+        for name, category in category_of.items():
+            self.automaton.add_word(name, (name, category))
+        if self.names:
+            self.automaton.make_automaton()
+
+        self.trigram_index = TrigramIndex(self.names)
+        self.substring_index = SubstringIndex(self.names)
+
+    def preprocess(self, text):
+        return self.normalizer(text)
+
+    def fuzzy_rows(self, token, threshold=None):
+        """(row, score) of the keywords with fuzz.ratio(token, keyword) >= threshold, in keyword order"""
+        threshold = self.fuzzy_threshold if threshold is None else threshold
+        hits = []
+        for row in self.trigram_index.candidates(token, threshold).tolist():
+            score = fuzz.ratio(token, self.names[row])
+            if score >= threshold:
+                hits.append((row, score))
+        return hits
+
+    def substring_rows(self, token):
+        """Rows of the keywords that contain `token` and are not equal to it, in keyword order"""
+        return [row for row in self.substring_index.rows_containing(token).tolist() if self.names[row] != token]
+
+    def classify(self, text, fuzzy_threshold=None):
+        """
+        (matches, relevance) for one text:
+            matches    category -> [(keyword or token, score)]
+            relevance  category -> summed match weight / number of keywords of the category
+        """
+        return self._classify(self.preprocess(text), {}, fuzzy_threshold)
+
+    def classify_many(self, texts, fuzzy_threshold=None):
+        """classify() for many texts; a token seen in several texts is looked up once"""
+        seen = {}
+        return [self._classify(normalized, seen, fuzzy_threshold) for normalized in self.normalizer.many(texts)]
+
+    def _classify(self, normalized, seen, fuzzy_threshold):
+        text, tokens = normalized
+        matches = defaultdict(list)
+        scores = defaultdict(float)
+
+        # Step 1: Exact & multi-word match via Aho-Corasick
+        if self.names:
+            for end_idx, (kw, category) in self.automaton.iter(text):
+                matches[category].append((kw, 100))
+                scores[category] += 1.0
+
+        lookups = []
+        for token in tokens:
+            if token not in seen:
+                seen[token] = (self.fuzzy_rows(token, fuzzy_threshold), self.substring_rows(token))
+            lookups.append((token, seen[token]))
+
+        # Step 2: Fuzzy matching for spelling mistakes & partial matches
+        for token, (fuzzy, _) in lookups:
+            for row, score in fuzzy:
+                category = self.categories[row]
                 matches[category].append((token, score))
                 # Weight fuzzy matches lower than exact
                 scores[category] += score / 120
 
-    # Step 3: Partial match scoring (substrings)
-    for token in tokens:
-        for kw, category in keyword_to_category.items():
-            if token in kw and token != kw:
+        # Step 3: Partial match scoring (substrings)
+        for token, (_, partial) in lookups:
+            for row in partial:
+                category = self.categories[row]
                 matches[category].append((token, 60))  # partial match weight
                 scores[category] += 0.5
 
-    # Step 4: Compute weighted relevance score
-    relevance = {
-        cat: round(score / len(keywords[cat]), 2)
-        for cat, score in scores.items()
-    }
+        # Step 4: Compute weighted relevance score
+        relevance = {
+            cat: round(score / self.sizes[cat], 2)
+            for cat, score in scores.items()
+        }
 
-    return matches, relevance
+        return matches, relevance
 
 # ---------------------------
-# 5. Test the enhanced function
+# 3. Default classifier over the keywords above, built on first use
 # ---------------------------
-sentence = "Show me the account balance for WPF Enterprise"
-matches, relevance = match_keywords(sentence)
+_classifier = None
 
-print("Matches by category:", dict(matches))
-print("Category relevance scores:", relevance)
+def get_classifier():
+    global _classifier
+    if _classifier is None:
+        _classifier = KeywordClassifier(keywords, abbreviations)
+    return _classifier
 
+def preprocess(text):
+    """(text, tokens) lower-cased, punctuation dropped, known abbreviations expanded"""
+    return get_classifier().preprocess(text)
+
+def match_keywords(sentence, fuzzy_threshold=85):
+    return get_classifier().classify(sentence, fuzzy_threshold)
 
 # ---------------------------
+# 4. Example
+# ---------------------------
+if __name__ == "__main__":
+    sentence = "Show me the account balance for WPF Enterprise"
+    matches, relevance = match_keywords(sentence)
+
+    print("Matches by category:", dict(matches))
+    print("Category relevance scores:", relevance)
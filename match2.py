@@ -1,53 +1,145 @@
 from pkgutil import get_data
-import re
+import os
+import pickle
+import threading
+from bisect import bisect_left
 import ahocorasick
+import numpy as np
 from collections import defaultdict
 from rapidfuzz import fuzz, process
 import pymysql
+from trigram_index import TrigramIndex
+from substring_index import SubstringIndex
+from master_store import MasterStore
+from master_sync import ConnectionPool, MasterLoader, MasterSync
+from spans import ngram_spans, CoverageMask, non_overlapping
+from normalizer import Normalizer
+from result_cache import ResultCache
+
+# Shortlists holding more than this share of a category are not worth gathering:
+# extractOne over the whole category is cheaper
+FULL_SCAN_SHARE = 0.5
+
+# Queries are lower-cased with punctuation dropped ("pvt." -> "pvt")
+QUERY_NORMALIZER = Normalizer(punctuation="")
+
+
+class MasterIndex:
+    def __init__(self, store, automaton, trigram_index, base_rows, overlay_automaton=None, version=0,
+                 substring_index=None, deleted=None):
+        """
+        Everything a query reads, published as one object so a query never mixes
+        structures from before and after an update. Never modified once published:
+        updates build a new one with replace() and swap HybridMasterMatcher.index.
+            store              MasterStore; only grows / gains tombstones, rows stay put
+            automaton          name_lower -> tuple of rows, rows < base_rows
+            trigram_index      category -> TrigramIndex over the first base rows of the category
+            overlay_automaton  name_lower -> tuple of rows >= base_rows, or None
+            version            masters version these structures belong to
+            substring_index    category -> SubstringIndex over the same rows as
+                               trigram_index, built on the first names_containing()
+            deleted            frozenset of tombstoned rows as of this version; queries
+                               read it instead of store.deleted, which writers swap
+        """
+        self.store = store
+        self.automaton = automaton
+        self.trigram_index = trigram_index
+        self.base_rows = base_rows
+        self.overlay_automaton = overlay_automaton
+        self.version = version
+        self.substring_index = {} if substring_index is None else substring_index
+        self.deleted = store.deleted if deleted is None else deleted
+
+    def replace(self, **changes):
+        fields = dict(self.__dict__)
+        fields.update(changes)
+        return MasterIndex(**fields)
 
 
 class HybridMasterMatcher:
-    def __init__(self, threshold=80, top_n=5):
+    def __init__(self, threshold=80, top_n=5, batch=False, workers=-1, compact_every=1000,
+                 cache_size=1024, cache_ttl=None, phrase_cache_size=50000):
         """
         threshold: fuzzy match minimum score (0-100)
         top_n: max matches per category
+        batch: score all n-grams of a query against a category in one cdist call
+        workers: threads used by cdist in batch mode (-1 = all cores)
+        compact_every: incremental changes after which the indexes are rebuilt
+            in a background thread (0 = only when compact() is called)
+        cache_size / cache_ttl: LRU result cache per normalized query (0 = off),
+            entries expire after cache_ttl seconds and whenever the masters change
+        phrase_cache_size: phrase -> best matches memo shared by all queries (0 = off)
         """
         self.threshold = threshold
         self.top_n = top_n
-        self.masters_by_category = {}
-        self.masters_lower = {}
-        self.automaton = ahocorasick.Automaton()
-        self.master_index = []  # [(category, master_id, master_name_lower)]
+        self.batch = batch
+        self.workers = workers
+        # Replaced as a whole on every load / add / remove / compaction;
+        # a query reads self.index once and uses only that
+        self.index = MasterIndex(MasterStore(), ahocorasick.Automaton(), {}, 0)
+
+        # Incremental updates: rows >= base_rows were added after the indexes were
+        # built and live in the overlay; removed rows are tombstoned in the store
+        self.compact_every = compact_every
+        self.pending_changes = 0
+        self._lock = threading.RLock()    # serializes writers, queries never take it
+        self._journal = None              # changes made while a compaction is running
+        self._compaction = None           # background compaction thread, if any
+
+        self.result_cache = ResultCache(cache_size, cache_ttl)
+        # (phrase, threshold) -> [(row, score), ...]; [] records a phrase that matched nothing.
+        # Holds store rows, so it is also cleared when compaction renumbers them
+        self.phrase_cache = ResultCache(phrase_cache_size)
     
+    # Read-only views of the current index
+    @property
+    def store(self):
+        return self.index.store
+
+    @property
+    def automaton(self):
+        return self.index.automaton
+
+    @property
+    def trigram_index(self):
+        return self.index.trigram_index
+
+    @property
+    def base_rows(self):
+        return self.index.base_rows
+
+    @property
+    def overlay_automaton(self):
+        return self.index.overlay_automaton
+
+    @property
+    def masters_version(self):
+        """Bumped on every load / add / remove / compaction, invalidates the caches"""
+        return self.index.version
+
+    def connect_db(self):
+        """New connection to the masters database"""
+        return pymysql.connect( host='3.108.40.112',user='talkingtotals',password='T@lkingTotals!@#$', database='tt_customer_db_1')
+
     def get_db_data(self):
-        """fetch the data from databse or any other source"""
-        dict = {}
-        conn = pymysql.connect( host='3.108.40.112',user='talkingtotals',password='T@lkingTotals!@#$', database='tt_customer_db_1')
-        cursor = conn.cursor()
-        queries = [
-            "SELECT id, name FROM ledger_groups WHERE company_id = '1'",
-            "SELECT id, name FROM ledgers WHERE company_id = '1'",
-            "SELECT id, name FROM stock_items WHERE company_id = '1'",
-            "SELECT id, name FROM stock_item_categories WHERE company_id = '1'",
-            "SELECT id, name FROM stock_item_groups WHERE company_id = '1'",
-            "SELECT id, name FROM cost_centres WHERE company_id = '1'",
-        ]
-        keyword = ['Groups', 'Ledgers', 'Stock', 'Stock_Categories', 'Stock_Groups', 'Cost_Center']
-        index = 0
-        for query in queries:
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            print(f"Fetched {len(rows)} rows for {keyword[index]}")
-            for row in rows:
-                id, name = row 
-                # print(row)
-                dict.setdefault(keyword[index], []).append((id, name))   
-            index += 1
-        cursor.close()
-        conn.close()
-        for item in dict:
-            print(f"{item} : {len(dict[item])}")
-        return dict
+        """
+        fetch the data from databse or any other source: one MasterLoader full
+        load (tables in parallel, rows streamed) as {category: [(id, name), ...]}
+        """
+        store, timings = MasterLoader(self.connect_db).fetch()
+        for table, stats in timings.items():
+            print(f"Fetched {stats['rows']} rows from {table}")
+        return store.to_dict()
+
+    def sync_from_db(self, **options):
+        """
+        Full load straight into this matcher through a pooled MasterSync, which is
+        returned: its refresh() then applies only the rows changed since.
+        options: MasterSync settings, e.g. deleted_column="deleted_at"
+        """
+        sync = MasterSync(ConnectionPool(self.connect_db).connect, **options)
+        sync.load(self)
+        return sync
 
     def generate_ngrams(self, tokens, max_n=4):
         """Generate n-grams from a list of tokens"""
@@ -60,9 +152,7 @@ class HybridMasterMatcher:
     
     def preprocess(self, text: str) -> str:
         """Normalize query for matching"""
-        text = text.lower()
-        text = re.sub(r'[^a-z0-9\s]', '', text)
-        return text
+        return QUERY_NORMALIZER(text)[0]
     
     def load_masters(self, masters_dict):
         """
@@ -72,48 +162,332 @@ class HybridMasterMatcher:
             ...
         }
         """
-        self.masters_by_category = masters_dict
-        self.masters_lower = {
-            cat: [(mid, name.lower()) for mid, name in items]
-            for cat, items in masters_dict.items()
-        }
+        self.load_store(MasterStore.from_dict(masters_dict))
+
+    def load_store(self, store):
+        """Index an already built MasterStore (see master_sync.MasterLoader)"""
+        self._install(store, self._make_automaton(store, range(len(store))), self._make_trigram_index(store))
+
+    def _install(self, store, automaton, trigram_index):
+        """Publish freshly built structures with an empty overlay"""
+        with self._lock:
+            self.index = MasterIndex(store, automaton, trigram_index, len(store),
+                                     version=self.masters_version + 1)
+            self.pending_changes = 0
 
-        # Build Aho-Corasick automaton for fast exact/substring detection
-        idx = 0
-        for cat, items in self.masters_lower.items():
-            for mid, name_lower in items:
-                self.automaton.add_word(name_lower, (cat, mid, name_lower))
-                self.master_index.append((cat, mid, name_lower))
-                idx += 1
+    def _make_automaton(self, store, rows):
+        # Every row of a name is kept: removing one master must not hide another with the same name
+        rows_by_name = defaultdict(list)
+        for row in rows:
+            if store.is_live(row):
+                rows_by_name[store.name_lower(row)].append(row)
+        automaton = ahocorasick.Automaton()
+        for name, name_rows in rows_by_name.items():
+            automaton.add_word(name, tuple(name_rows))
+        automaton.make_automaton()
+        return automaton
 
-        self.automaton.make_automaton()
+    def _make_trigram_index(self, store):
+        return {cat: TrigramIndex(store.category_names_lower(cat)) for cat in store.categories}
 
-    def match_query_with_phrases(self,query, masters_dict, threshold=70):
+    def build_automaton(self):
+        """Build Aho-Corasick automaton for fast exact/substring detection"""
+        with self._lock:
+            index = self.index
+            self.index = index.replace(automaton=self._make_automaton(index.store, range(index.base_rows)))
+
+    def build_trigram_index(self):
+        """Build per-category character posting lists used to shortlist fuzzy candidates"""
+        with self._lock:
+            self.index = self.index.replace(trigram_index=self._make_trigram_index(self.index.store))
+
+    # --------------------------
+    # Incremental updates
+    # --------------------------
+    def add_master(self, category, master_id, name):
+        """Add one master without rebuilding the indexes; returns its store row"""
+        with self._lock:
+            index = self.index
+            if index.store.row(category, master_id) is not None:
+                raise ValueError(f"{category} master {master_id} is already loaded, use rename_master()")
+            # Appending keeps existing rows in place, so queries on the current index are unaffected
+            row = index.store.add(category, master_id, name, name.lower())
+            trigram_index = index.trigram_index
+            if category not in trigram_index:
+                trigram_index = {**trigram_index, category: TrigramIndex()}
+            self._record(index.replace(trigram_index=trigram_index,
+                                       overlay_automaton=self._make_overlay(index)),
+                         ("add", category, master_id, name))
+            return row
+
+    def remove_master(self, category, master_id):
+        with self._lock:
+            index = self.index
+            row = index.store.row(category, master_id)
+            if row is None:
+                raise KeyError(f"{category} master {master_id} is not loaded")
+            index.store.remove(row)
+            index = index.replace(deleted=index.store.deleted)
+            if row >= index.base_rows:
+                index = index.replace(overlay_automaton=self._make_overlay(index))
+            self._record(index, ("remove", category, master_id))
+
+    def rename_master(self, category, master_id, new_name):
+        with self._lock:
+            self.remove_master(category, master_id)
+            return self.add_master(category, master_id, new_name)
+
+    def _make_overlay(self, index):
+        """The overlay automaton only holds rows added since the last compaction"""
+        rows = range(index.base_rows, len(index.store))
+        return self._make_automaton(index.store, rows) if len(rows) else None
+
+    def _record(self, index, change):
+        """Publish `index` under a new version and count / journal the change"""
+        self.index = index.replace(version=self.masters_version + 1)
+        self.pending_changes += 1
+        if self._journal is not None:
+            self._journal.append(change)
+        elif self.compact_every and self.pending_changes >= self.compact_every:
+            self.compact(background=True)
+
+    def compact(self, background=False):
+        """
+        Rebuild store, automaton and trigram index without tombstones and fold
+        the overlay in. Queries keep using the old structures until the swap;
+        changes made meanwhile are journaled and replayed onto the new ones.
+        background: start a thread and return it (or the one already running).
+        Otherwise return once compacted, waiting for a running compaction first.
+        """
+        while True:
+            with self._lock:
+                running = self._compaction
+                if running is None:
+                    if self._journal is not None:
+                        return None  # called from the journal replay of _compact()
+                    self._journal = []
+                    store = self.index.store
+                    source, upto, deleted = store, len(store), store.deleted
+                    if background:
+                        thread = threading.Thread(target=self._compact, args=(source, upto, deleted),
+                                                  daemon=True)
+                        self._compaction = thread
+                        thread.start()
+                        return thread
+                    break
+                if background:
+                    return running
+            running.join()
+        self._compact(source, upto, deleted)
+        return None
+
+    def _compact(self, source, upto, deleted):
+        try:
+            store = source.compacted(upto, deleted)
+            automaton = self._make_automaton(store, range(len(store)))
+            trigram_index = self._make_trigram_index(store)
+        except BaseException:
+            with self._lock:
+                self._journal = None
+                self._compaction = None
+            raise
+        with self._lock:
+            journal, self._journal = self._journal, None
+            self._compaction = None
+            # Rows are renumbered: the version bump keeps results computed against
+            # the old store out of the caches
+            self._install(store, automaton, trigram_index)
+            self.phrase_cache.clear()
+            for change in journal:
+                if change[0] == "add":
+                    self.add_master(*change[1:])
+                else:
+                    self.remove_master(*change[1:])
+
+    def save_snapshot(self, path):
+        """
+        Persist the built index to directory `path` so workers can skip
+        get_db_data() + load_masters() on boot: the MasterStore columns
+        (memory-mapped on load, see MasterStore.save), automaton.bin, the
+        pickled Aho-Corasick automaton, and trigram_<category code>.*, the
+        character posting lists and counts (memory-mapped too, see TrigramIndex.save). Pending changes are compacted first,
+        after any background compaction finishes, and the files are written under
+        the writer lock so store and automaton agree row for row.
+        """
+        while True:
+            if self.pending_changes or self._compaction is not None:
+                self.compact()
+            with self._lock:
+                if self.pending_changes or self._compaction is not None:
+                    continue  # changed again before we got the lock
+                index = self.index
+                os.makedirs(path, exist_ok=True)
+                # Every file goes in under a new inode: workers keep the snapshot they mapped
+                automaton_path = os.path.join(path, "automaton.bin")
+                index.automaton.save(f"{automaton_path}.{os.getpid()}.tmp", pickle.dumps)
+                os.replace(f"{automaton_path}.{os.getpid()}.tmp", automaton_path)
+                for code, category in enumerate(index.store.categories):
+                    index.trigram_index[category].save(os.path.join(path, f"trigram_{code}"))
+                # The store writes its manifest last, which marks the snapshot complete
+                index.store.save(path)
+                return
+
+    def load_snapshot(self, path):
+        """Restore an index written by save_snapshot() instead of calling load_masters()"""
+        store = MasterStore.load(path)
+        automaton = ahocorasick.load(os.path.join(path, "automaton.bin"), pickle.loads)
+        trigram_index = {}
+        for code, category in enumerate(store.categories):
+            names = store.category_names_lower(category)
+            index = TrigramIndex.load(os.path.join(path, f"trigram_{code}"), names)
+            if index is None:
+                # Snapshot written before the posting lists were saved
+                index = TrigramIndex(names)
+            trigram_index[category] = index
+        self._install(store, automaton, trigram_index)
+
+    def score_matrix(self, phrases, names, score_cutoff=None):
+        """Score every phrase against every name in a single cdist call -> (len(phrases), len(names))"""
+        return process.cdist(phrases, names, scorer=fuzz.ratio, score_cutoff=score_cutoff,
+                             dtype=np.float32, workers=self.workers)
+
+    def _best_per_category(self, phrases, store, threshold, index=None):
+        """
+        Memoized _score_phrases(): only phrases not seen since the masters last changed are scored.
+        index: the MasterIndex `store` belongs to; None scans an ad-hoc store in full, uncached
+        """
+        if index is None:
+            return self._score_phrases(phrases, store, threshold)
+        version = index.version
+        best = [self.phrase_cache.get((phrase, threshold), version) for phrase in phrases]
+        missing = [i for i, hits in enumerate(best) if hits is None]
+        if missing:
+            scored = self._score_phrases([phrases[i] for i in missing], store, threshold, index.trigram_index,
+                                         index.deleted)
+            for i, hits in zip(missing, scored):
+                best[i] = hits
+                self.phrase_cache.put((phrases[i], threshold), hits, version)
+        return best
+
+    def _score_phrases(self, phrases, store, threshold, trigram_index=None, deleted=None):
+        """
+        For each phrase, the best (row, score) of every category at or above threshold,
+        scored with one cdist per category in batch mode, else extractOne per phrase
+        over the trigram-index shortlist (full scan without trigram_index).
+        deleted: tombstone snapshot of the MasterIndex, defaults to the store's
+        """
+        best = [[] for _ in phrases]
+        if not phrases:
+            return best
+        for category in store.categories:
+            cat_rows = store.category_rows(category)
+            # Copy: add_master() may append to the cached list while we score
+            names_lower = store.category_names_lower(category)[:]
+            if not names_lower:
+                continue
+            excluded = store.deleted_positions(category, deleted)
+            if excluded is not None:
+                excluded = excluded[excluded < len(names_lower)]
+            if self.batch:
+                scores = self.score_matrix(phrases, names_lower, threshold)
+                if excluded is not None:
+                    scores[:, excluded] = 0
+                # argmax per phrase (row), i.e. the best master for each phrase, same as
+                # extractOne; the best phrase per master is picked later by the dedup
+                best_cols = scores.argmax(axis=1)
+                best_scores = scores[np.arange(len(phrases)), best_cols]
+                for i in np.flatnonzero(best_scores >= threshold).tolist():
+                    best[i].append((cat_rows[best_cols[i]], float(best_scores[i])))
+                continue
+
+            index = trigram_index[category] if trigram_index is not None else None
+            live = None
+            if excluded is not None:
+                live = np.ones(len(names_lower), dtype=bool)
+                live[excluded] = False
+            # Masters added after the index was built are always scored
+            overlay = np.arange(len(index), len(names_lower)) if index is not None else None
+            # Check each n-gram against master list
+            for i, phrase in enumerate(phrases):
+                candidates = None
+                if index is not None:
+                    # Only masters sharing enough trigrams can reach the threshold
+                    candidates = index.candidates(phrase, threshold)
+                    if len(candidates) > FULL_SCAN_SHARE * len(names_lower):
+                        candidates = None  # a plain scan is cheaper than gathering the shortlist
+                if candidates is not None:
+                    positions = np.concatenate([candidates, overlay])
+                    if live is not None:
+                        positions = positions[live[positions]]
+                    if not len(positions):
+                        continue
+                    base = int(np.searchsorted(positions, len(index)))
+                    choices = index.names[positions[:base]].tolist()
+                    choices += [names_lower[idx] for idx in positions[base:].tolist()]
+                    match = process.extractOne(phrase, choices, scorer=fuzz.ratio, score_cutoff=threshold)
+                    if match is not None:
+                        best[i].append((cat_rows[positions[match[2]]], match[1]))
+                    continue
+                # Full scan, over-fetching by the number of tombstones so removed masters can be skipped
+                limit = 1 if excluded is None else len(excluded) + 1
+                for _, score, idx in process.extract(phrase, names_lower, scorer=fuzz.ratio,
+                                                     score_cutoff=threshold, limit=limit):
+                    if live is None or live[idx]:
+                        best[i].append((cat_rows[idx], score))
+                        break
+        return best
+
+    def match_query_with_phrases(self,query, masters_dict=None, threshold=70, cover=False, cover_cutoff=90,
+                                 max_n=5):
+        """
+        masters_dict: defaults to the masters passed to load_masters(); the
+        trigram index is only used in that case, any other dict is scanned in full
+        cover: longest-first span search; once an n-gram scores >= cover_cutoff its
+            tokens are masked and shorter n-grams inside it are never scored.
+            Results carry their token "span" and do not overlap.
+        """
         # Preprocess query
-        query_norm = re.sub(r'[^a-z0-9\s]', '', query.lower())
-        tokens = query_norm.split()
+        _, tokens = QUERY_NORMALIZER(query)
+
+        index = self.index
+        version = index.version
+        cache_key = None
+        if masters_dict is None:
+            cache_key = ("phrases", " ".join(tokens), threshold, max_n, cover, cover_cutoff)
+            cached = self.result_cache.get(cache_key, version)
+            if cached is not None:
+                return [dict(r, query=query) for r in cached]
 
         # Generate n-grams (prioritize longer first)
-        ngrams = self.generate_ngrams(tokens, max_n=5)
-        ngrams.sort(key=lambda x: len(x.split()), reverse=True)
+        spans = ngram_spans(tokens, max_n=max_n)
+
+        if masters_dict is None:
+            store = index.store
+        else:
+            store, index = MasterStore.from_dict(masters_dict), None
 
         results = []
-        for category, items in masters_dict.items():
-            names_lower = [name.lower() for _, name in items]
-            # print(names_lower)
-            # Check each n-gram against master list
-            for phrase in ngrams:
-                match, score, idx = process.extractOne(phrase, names_lower, scorer=fuzz.ratio)
-                if score >= threshold:
-                    mid, original_name = items[idx]
-                    results.append({
-                        "query": query,
-                        "category": category,
-                        "master_id": mid,
-                        "master_name": original_name,
-                        "score": round(score, 2),
-                        "matched_phrase": phrase
-                    })
+        if not cover:
+            best = self._best_per_category([phrase for _, _, phrase in spans], store, threshold, index)
+            for (start, end, phrase), hits in zip(spans, best):
+                for row, score in hits:
+                    results.append(self._result(query, store, row, score, matched_phrase=phrase))
+        else:
+            mask = CoverageMask(len(tokens))
+            for n in range(min(len(tokens), max_n), 0, -1):
+                level = [span for span in spans if span[1] - span[0] == n and mask.is_free(span[0], span[1])]
+                best = self._best_per_category([phrase for _, _, phrase in level], store, threshold, index)
+                # Strongest spans of this length claim their tokens first
+                for i in sorted(range(len(level)), key=lambda i: -max((s for _, s in best[i]), default=0)):
+                    start, end, phrase = level[i]
+                    if not best[i] or not mask.is_free(start, end):
+                        continue
+                    for row, score in best[i]:
+                        results.append(self._result(query, store, row, score,
+                                                    matched_phrase=phrase, span=(start, end)))
+                    if max(score for _, score in best[i]) >= cover_cutoff:
+                        mask.claim(start, end)
+            results = non_overlapping(results)
 
         # Keep best match per master_id
         unique = {}
@@ -122,43 +496,97 @@ class HybridMasterMatcher:
             if key not in unique or r["score"] > unique[key]["score"]:
                 unique[key] = r
 
-        return list(unique.values())
+        results = list(unique.values())
+        if cache_key is not None:
+            self.result_cache.put(cache_key, [dict(r) for r in results], version)
+        return results
+
+    def _result(self, query, store, row, score, **extra):
+        result = {
+            "query": query,
+            "category": store.category(row),
+            "master_id": store.master_id(row),
+            "master_name": store.name(row),
+            "score": round(float(score), 2)
+        }
+        result.update(extra)
+        return result
+
+    def names_containing(self, text, category=None):
+        """
+        Partial-name lookup: live masters whose lower-cased name contains `text`
+        (e.g. "insul"), optionally of one category, in row order. Scored by the
+        share of the name the text covers.
+        """
+        text = text.lower()
+        index = self.index
+        store = index.store
+        results = []
+        if not text:
+            return results
+        for cat in (store.categories if category is None else [category]):
+            cat_rows = store.category_rows(cat)
+            names_lower = store.category_names_lower(cat)
+            # Rows of the last compaction come from the suffix array, later ones are scanned
+            base = bisect_left(cat_rows, index.base_rows)
+            positions = self._substring_index(index, cat, names_lower, base).rows_containing(text).tolist()
+            positions += [pos for pos in range(base, len(cat_rows)) if text in names_lower[pos]]
+            for pos in positions:
+                row = cat_rows[pos]
+                if row not in index.deleted:
+                    results.append(self._result(text, store, row, 100 * len(text) / len(names_lower[pos])))
+        return results
+
+    def _substring_index(self, index, category, names_lower, base):
+        substring_index = index.substring_index.get(category)
+        if substring_index is None:
+            substring_index = SubstringIndex(names_lower[:base])
+            with self._lock:
+                if self.index is index:
+                    self.index = index.replace(substring_index={**index.substring_index, category: substring_index})
+        return substring_index
 
     def match_query(self, query: str):
         """Return matches for a query"""
-        query_norm = self.preprocess(query)
+        query_norm, tokens = QUERY_NORMALIZER(query)
+        index = self.index
+        version = index.version
+        cache_key = ("match", query_norm, self.threshold, self.top_n)
+        cached = self.result_cache.get(cache_key, version)
+        if cached is not None:
+            return [dict(r, query=query) for r in cached]
+
         matches = defaultdict(list)
         scored_results = []
+        store = index.store
+        deleted = index.deleted
 
-        # Step 1: Exact / substring matches via Aho-Corasick
-        for end_idx, (cat, mid, name_lower) in self.automaton.iter(query_norm):
-            original_name = dict(self.masters_by_category[cat])[mid]
-            scored_results.append({
-                "query": query,
-                "category": cat,
-                "master_id": mid,
-                "master_name": original_name,
-                "score": 100.0
-            })
+        # Step 1: Exact / substring matches via Aho-Corasick (base + overlay of added masters)
+        for automaton in (index.automaton, index.overlay_automaton):
+            if automaton is None:
+                continue
+            for end_idx, rows in automaton.iter(query_norm):
+                # Snapshots written before rows were grouped by name hold a single row
+                for row in (rows if isinstance(rows, tuple) else (rows,)):
+                    if row not in deleted:
+                        scored_results.append(self._result(query, store, row, 100.0))
 
         # Step 2: Fuzzy matching on tokens to catch typos
-        tokens = query_norm.split()
-        for token in tokens:
-            # Search top_n fuzzy matches for each token across all masters
-            for cat, items in self.masters_lower.items():
-                names_lower = [name for _, name in items]
-                best_matches = process.extract(token, names_lower, scorer=fuzz.ratio, limit=self.top_n)
-                for name_lower, score, idx in best_matches:
-                    if score >= self.threshold:
-                        mid, _ = self.masters_lower[cat][idx]
-                        original_name = dict(self.masters_by_category[cat])[mid]
-                        scored_results.append({
-                            "query": query,
-                            "category": cat,
-                            "master_id": mid,
-                            "master_name": original_name,
-                            "score": round(score, 2)
-                        })
+        if self.batch:
+            scored_results.extend(self._match_tokens_batch(query, tokens, store, deleted))
+        else:
+            # Over-fetch by the number of tombstones so removed masters can be skipped
+            limit = self.top_n + len(deleted)
+            for token in tokens:
+                # Search top_n fuzzy matches for each token across all masters
+                for cat in store.categories:
+                    names_lower = store.category_names_lower(cat)
+                    cat_rows = store.category_rows(cat)
+                    best_matches = process.extract(token, names_lower, scorer=fuzz.ratio, limit=limit)
+                    live = [(score, cat_rows[idx]) for _, score, idx in best_matches if cat_rows[idx] not in deleted]
+                    for score, row in live[:self.top_n]:
+                        if score >= self.threshold:
+                            scored_results.append(self._result(query, store, row, score))
 
         # Step 3: Deduplicate results by (category, master_id)
         unique_results = {}
@@ -167,7 +595,31 @@ class HybridMasterMatcher:
             if key not in unique_results or r["score"] > unique_results[key]["score"]:
                 unique_results[key] = r
 
-        return list(unique_results.values())
+        results = list(unique_results.values())
+        self.result_cache.put(cache_key, [dict(r) for r in results], version)
+        return results
+
+    def _match_tokens_batch(self, query, tokens, store, deleted):
+        """Step 2 of match_query in batch mode: top_n per token per category from one cdist per category"""
+        results = []
+        if not tokens:
+            return results
+        for cat in store.categories:
+            names_lower = store.category_names_lower(cat)[:]
+            if not names_lower:
+                continue
+            cat_rows = store.category_rows(cat)
+            scores = self.score_matrix(tokens, names_lower, self.threshold)
+            excluded = store.deleted_positions(cat, deleted)
+            if excluded is not None:
+                scores[:, excluded[excluded < len(names_lower)]] = 0
+            for row_scores in scores:
+                # Same order as process.extract: best score first, lower index on ties
+                hits = np.flatnonzero(row_scores >= self.threshold)
+                hits = hits[np.argsort(-row_scores[hits], kind="stable")][:self.top_n]
+                for idx in hits.tolist():
+                    results.append(self._result(query, store, cat_rows[idx], row_scores[idx]))
+        return results
 
     
 
@@ -176,8 +628,7 @@ class HybridMasterMatcher:
 # --------------------------
 if __name__ == "__main__":
     matcher = HybridMasterMatcher(threshold=80, top_n=5)
-    masters_dict = matcher.get_db_data()
-    matcher.load_masters(masters_dict)
+    sync = matcher.sync_from_db()
 
     queries = [
         # 'How much 3M Tape 79 did we sell this month',
@@ -304,7 +755,7 @@ if __name__ == "__main__":
 
     for q in queries:
         # results = matcher.match_query(q)
-        results = matcher.match_query_with_phrases(q, masters_dict)
+        results = matcher.match_query_with_phrases(q)
         print(f"\nQuery: {q}")
         for r in results:
             print(r)
@@ -1,29 +1,54 @@
-import re
+import logging
 import pymysql
-import pandas as pd
 from rapidfuzz import fuzz, process
+from master_store import MasterStore
+from spans import ngram_spans, CoverageMask, non_overlapping
+from vocabulary import Vocabulary
+from normalizer import Normalizer
+from result_cache import ResultCache
+
+logger = logging.getLogger(__name__)
 
 # ---------------------------------------
 # 1. DB connection and master data fetch
 # ---------------------------------------
-def get_master_data(db_config):
-    conn = pymysql.connect(**db_config)
+MASTER_COLUMNS = ("id", "name", "category", "master_name")
+
+def get_master_data(db_config, pool=None):
+    """
+    Master rows as columns: {"id": [...], "name": [...], "category": [...], "master_name": [...]}
+    pool: optional master_sync.ConnectionPool reused across calls instead of a new connection
+    """
+    conn = pool.connect() if pool is not None else pymysql.connect(**db_config)
     query = """
-        SELECT name , 'category'  as category, 'ledger' as master_name
+        SELECT id, name , 'category'  as category, 'ledger' as master_name
         FROM ledgers where company_id = 1
     """
-    df = pd.read_sql(query, conn)
-    conn.close()
-    return df
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query)
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    return {column: [row[i] for row in rows] for i, column in enumerate(MASTER_COLUMNS)}
+
+def build_master_store(masters):
+    """
+    Columnar MasterStore used for matching, names normalized like the queries.
+    masters: columns as returned by get_master_data() (a DataFrame works too)
+    """
+    records = zip(masters["category"], masters["id"], masters["name"])
+    return MasterStore.from_records(records, normalize=normalize)
 
 # ---------------------------------------
 # 2. Normalization helper
 # ---------------------------------------
+# Lower-cased, every non-alphanumeric character a word break
+NORMALIZER = Normalizer()
+
 def normalize(text):
-    text = text.lower()
-    text = re.sub(r"[^a-z0-9\s]", " ", text)  # keep alphanumeric
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+    return NORMALIZER(text)[0]
 
 # ---------------------------------------
 # 3. Build dynamic stop words
@@ -37,63 +62,93 @@ BASE_STOP_WORDS = {
 GENERIC_FINANCE_WORDS = {"trend", "sales", "sale", "monthly", "quarterly", "yearly", "report"}
 
 
-def build_master_vocab(master_df):
-    vocab = set()
-    for name in master_df["name"]:
-        vocab.update(name.split())
-    return vocab
+def build_vocabulary(masters):
+    """
+    Vocabulary of the master names (tokens as normalize() makes them), with the
+    base and finance words as stop-word candidates. Keep it and add() / remove()
+    names as masters change instead of rebuilding.
+    """
+    return Vocabulary.from_names(masters["name"], BASE_STOP_WORDS | GENERIC_FINANCE_WORDS)
+
+def build_master_vocab(masters):
+    return build_vocabulary(masters).master_vocab
 
-def build_dynamic_stop_words(master_df):
-    vocab = set()
-    for name in master_df['master_name']:
-        tokens = normalize(name).split()
-        vocab.update(tokens)
-    stop_words = BASE_STOP_WORDS | GENERIC_FINANCE_WORDS
-    return {w for w in stop_words if w not in vocab}
+def build_dynamic_stop_words(masters):
+    return build_vocabulary(masters).stop_words
 
 # ---------------------------------------
 # 4. Remove stopwords
 # ---------------------------------------
+def stopword_normalizer(stop_words, master_vocab):
+    """
+    NORMALIZER that also drops stop words and short noise words (< 2 chars) not
+    in master_vocab; built once per (stop_words, master_vocab) pair
+    """
+    return NORMALIZER.replace(stop_words=stop_words, min_length=2, keep_short=master_vocab)
+
 def remove_stopwords(text, stop_words, master_vocab):
-    tokens = normalize(text).split()
-    # Remove tokens that are stopwords or are short noise words (< 2 chars) not in master vocab
-    clean_tokens = [t for t in tokens if (t not in stop_words) and (len(t) > 1 or t in master_vocab)]
-    return " ".join(clean_tokens)
+    return stopword_normalizer(stop_words, master_vocab)(text)[0]
 
 
 # ---------------------------------------
 # 5. Create n-grams
 # ---------------------------------------
 def generate_ngrams(tokens, n):
-    return [" ".join(tokens[i:i+n]) for i in range(len(tokens)-n+1)]
+    """Phrases of exactly n tokens (see spans.ngram_spans, which match_query uses)"""
+    return [phrase for start, end, phrase in ngram_spans(tokens, n) if end - start == n]
 
 def generate_all_ngrams(tokens, max_n=5):
-    all_ngrams = []
-    for n in range(min(len(tokens), max_n), 0, -1):  # longest first
-        all_ngrams.extend(generate_ngrams(tokens, n))
-    return all_ngrams
-
-def match_query(query, master_df, stop_words, master_vocab, threshold=80):
-    clean_query = remove_stopwords(query, stop_words, master_vocab)
-    tokens = clean_query.split()
-    ngrams = generate_all_ngrams(tokens)
+    """All 1..max_n-gram phrases, longest first"""
+    return [phrase for _, _, phrase in ngram_spans(tokens, max_n)]
+
+# (ngram, threshold) -> matches, shared across queries; an empty list is a cached miss
+phrase_cache = ResultCache(maxsize=50000)
+
+def match_phrase(ng, store, threshold):
+    """Matches of one n-gram against every category, memoized per store version"""
+    version = (store.stamp, store.version)
+    cached = phrase_cache.get((ng, threshold), version)
+    if cached is not None:
+        return cached
+    hits = []
+    for category in store.categories:
+        names = store.category_names_lower(category)
+        # Best 3 at or above threshold; rows are resolved straight from the store's columns
+        results = process.extract(ng, names, scorer=fuzz.token_sort_ratio, limit=3, score_cutoff=threshold)
+        rows = store.category_rows(category)
+        for match_name, score, idx in results:
+            logger.debug("%r ~ %r (%s, position %d): %s", ng, match_name, category, idx, score)
+            row = rows[idx]
+            hits.append({
+                "ngram": ng,
+                "category": category,
+                "master_id": store.master_id(row),
+                "name": store.name(row),
+                "score": score
+            })
+    phrase_cache.put((ng, threshold), hits, version)
+    return hits
+
+def match_query(query, store, stop_words, master_vocab, threshold=80, cover=False, cover_cutoff=90):
+    """
+    cover: longest-first span search; an n-gram scoring >= cover_cutoff masks its
+        tokens so the shorter n-grams inside it are skipped, and the returned
+        matches (with their token "span") do not overlap
+    """
+    _, tokens = stopword_normalizer(stop_words, master_vocab)(query)
+    mask = CoverageMask(len(tokens))
 
     matches = []
-    for ng in ngrams:
-        results = process.extract(ng, master_df["name"], scorer=fuzz.token_sort_ratio, limit=3)
-        for match_name, score, idx in results:
-            print(f'match name is {match_name}')
-            print(f'score is {score}')
-            print(f'idx is {idx}')
-            if score >= threshold:
-                matches.append({
-                    "query": query,
-                    "ngram": ng,
-                    "category": master_df.iloc[idx]["category"],
-                    # "master_id": master_df.iloc[idx]["master_id"],
-                    "name": master_df.iloc[idx]["name"],
-                    "score": score
-                })
+    for start, end, ng in ngram_spans(tokens):
+        if cover and not mask.is_free(start, end):
+            continue
+        hits = match_phrase(ng, store, threshold)
+        for hit in hits:
+            matches.append({"query": query, **hit, "span": (start, end)})
+        if cover and hits and max(hit["score"] for hit in hits) >= cover_cutoff:
+            mask.claim(start, end)
+    if cover:
+        matches = non_overlapping(matches)
     # Remove duplicates by master_id keeping best score
     unique_matches = {}
     for m in matches:
@@ -161,14 +216,15 @@ if __name__ == "__main__":
 
     # Fetch master data
     # print(f"fetching master")
-    master_df = get_master_data(db_config)
-    # print(f'maser df is {master_df}')
+    masters = get_master_data(db_config)
 
-    master_vocab = build_master_vocab(master_df)
+    store = build_master_store(masters)
 
     # Build dynamic stop words
     print(f'buidling stop words')
-    stop_words = build_dynamic_stop_words(master_df)
+    vocabulary = build_vocabulary(masters)
+    master_vocab = vocabulary.master_vocab
+    stop_words = vocabulary.stop_words
 
     print(f'Stop words are {stop_words}')
 
@@ -182,6 +238,6 @@ if __name__ == "__main__":
     for q in queries:
         print(f"\nQuery: {q}")
         # matches = match_query_to_master(q, master_df, stop_words)
-        matches = match_query(q, master_df, stop_words, master_vocab, threshold=70)
+        matches = match_query(q, store, stop_words, master_vocab, threshold=70)
         for m in matches:
             print(m)
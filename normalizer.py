@@ -0,0 +1,110 @@
+# ---------------------------------------
+# Query normalization shared by the matchers: case folding, punctuation
+# mapping, abbreviation expansion and stop-word removal in one pass
+# ---------------------------------------
+
+LETTERS = {
+    "ascii": lambda ch: "a" <= ch <= "z" or "0" <= ch <= "9",
+    "word": lambda ch: ch.isalnum() or ch == "_",  # what re's \w matches
+    "any": lambda ch: not ch.isspace(),  # case and whitespace folding only
+}
+
+VARIANT_CACHE_SIZE = 8  # replace() copies kept per Normalizer
+
+
+class _CharTable(dict):
+    """str.translate() table filled on demand: each code point is worked out once, then looked up"""
+    def __init__(self, keep, punctuation):
+        super().__init__()
+        self.keep = keep
+        self.punctuation = punctuation
+
+    def __missing__(self, code):
+        out = []
+        for ch in chr(code).lower():
+            if self.keep(ch):
+                out.append(ch)
+            elif ch.isspace():
+                out.append(" ")
+            else:
+                out.append(self.punctuation)
+        value = "".join(out)
+        self[code] = value
+        return value
+
+
+_tables = {}  # (letters, punctuation) -> _CharTable, shared by every Normalizer
+
+
+def _table(letters, punctuation):
+    table = _tables.get((letters, punctuation))
+    if table is None:
+        table = _tables.setdefault((letters, punctuation), _CharTable(LETTERS[letters], punctuation))
+    return table
+
+
+class Normalizer:
+    def __init__(self, letters="ascii", punctuation=" ", abbreviations=None, stop_words=(),
+                 min_length=1, keep_short=()):
+        """
+        letters: "ascii" keeps a-z and 0-9 after lower-casing, "word" keeps any
+            unicode letter or digit and "_", "any" keeps every non-space character
+        punctuation: what every other non-space character becomes; " " splits
+            words ("3m-tape" -> "3m tape"), "" joins them ("3mtape")
+        abbreviations: {token: expansion}, an expansion may be several words
+        stop_words: tokens dropped, checked after expansion
+        min_length / keep_short: tokens shorter than min_length are dropped
+            unless they are in keep_short
+        Case folding and punctuation are one str.translate() over a cached
+        table; the token filters are one pass over the split words.
+        """
+        self.letters = letters
+        self.punctuation = punctuation
+        self.abbreviations = dict(abbreviations or {})
+        self.stop_words = stop_words
+        self.min_length = min_length
+        self.keep_short = keep_short
+        self._table = _table(letters, punctuation)
+        self._expansions = {token: tuple(words.split()) for token, words in self.abbreviations.items()}
+        self._filtered = bool(self.abbreviations or stop_words or min_length > 1)
+        self._variants = {}  # replace() arguments -> copy, most recent last
+
+    def replace(self, **changes):
+        """
+        Copy with some settings changed, e.g. replace(stop_words=...) per master set.
+        Copies are kept per distinct arguments, so calling it per query with the
+        same (frozen)sets only builds the copy once.
+        """
+        try:
+            key = tuple(sorted((name, frozenset(value) if isinstance(value, set) else value)
+                               for name, value in changes.items()))
+            hash(key)
+        except TypeError:
+            key = None  # e.g. an abbreviations dict: not cached
+        variant = self._variants.pop(key, None) if key is not None else None
+        if variant is None:
+            options = dict(letters=self.letters, punctuation=self.punctuation, abbreviations=self.abbreviations,
+                           stop_words=self.stop_words, min_length=self.min_length, keep_short=self.keep_short)
+            options.update(changes)
+            variant = Normalizer(**options)
+        if key is not None:
+            self._variants[key] = variant
+            if len(self._variants) > VARIANT_CACHE_SIZE:
+                self._variants.pop(next(iter(self._variants)), None)
+        return variant
+
+    def __call__(self, text):
+        """(normalized text, its tokens)"""
+        tokens = text.translate(self._table).split()
+        if self._filtered:
+            kept = []
+            for token in tokens:
+                for word in self._expansions.get(token, (token,)):
+                    if word not in self.stop_words and (len(word) >= self.min_length or word in self.keep_short):
+                        kept.append(word)
+            tokens = kept
+        return " ".join(tokens), tokens
+
+    def many(self, texts):
+        """[(normalized text, tokens)] for many queries"""
+        return [self(text) for text in texts]
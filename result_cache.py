@@ -0,0 +1,71 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+        Bounded LRU cache with optional time-to-live (seconds).
+        Entries are tied to a version (e.g. the master-set version): a get/put
+        with a different version clears the cache first.
+        maxsize=0 disables caching.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+
+    def get(self, key, version=None):
+        """Cached value or None"""
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, version=None):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def items(self):
+        """(key, value) pairs, least recently used first"""
+        with self._lock:
+            return [(key, entry[1]) for key, entry in self._entries.items()]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._entries),
+        }
@@ -0,0 +1,43 @@
+# ---------------------------------------
+# Token spans shared by the n-gram matchers (match2, match3_stop)
+# ---------------------------------------
+
+def ngram_spans(tokens, max_n=5):
+    """(start, end, phrase) for every 1..max_n-gram, longest first then left to right"""
+    spans = []
+    for n in range(min(len(tokens), max_n), 0, -1):
+        for i in range(len(tokens) - n + 1):
+            spans.append((i, i + n, " ".join(tokens[i:i + n])))
+    return spans
+
+
+class CoverageMask:
+    def __init__(self, n_tokens):
+        """Token positions already claimed by a confident longer match"""
+        self.covered = bytearray(n_tokens)
+
+    def is_free(self, start, end):
+        return not any(self.covered[start:end])
+
+    def claim(self, start, end):
+        self.covered[start:end] = b"\x01" * (end - start)
+
+
+def non_overlapping(matches):
+    """
+    Keep matches whose "span" does not overlap a stronger one (higher score,
+    then longer span). Several matches on the very same span are all kept.
+    """
+    ranked = sorted(matches, key=lambda m: (-m["score"], -(m["span"][1] - m["span"][0]), m["span"][0]))
+    mask = CoverageMask(max((m["span"][1] for m in matches), default=0))
+    taken = set()
+    kept = []
+    for m in ranked:
+        span = tuple(m["span"])
+        if span not in taken:
+            if not mask.is_free(*span):
+                continue
+            mask.claim(*span)
+            taken.add(span)
+        kept.append(m)
+    return kept
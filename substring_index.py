@@ -0,0 +1,97 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+# ---------------------------------------
+# Generalized suffix array over a list of names: every name containing a
+# query string, in O(len(query) * log(total chars) + matches)
+# ---------------------------------------
+SEPARATOR = "\x00"
+
+
+class SubstringIndex:
+    def __init__(self, names=()):
+        """
+        names: strings searched as given (normalize them first); the position
+        of each name is its row id.
+
+        The names are joined with SEPARATOR and every suffix of the result is
+        sorted by its first max-name-length characters (prefix doubling with
+        numpy), so the suffixes starting with a query form one contiguous run
+        of the array, found by binary search.
+        """
+        names = list(names)
+        self.text = SEPARATOR.join(names) + SEPARATOR
+        self.max_len = max(map(len, names), default=0)
+        lengths = np.fromiter((len(name) + 1 for name in names), dtype=np.int64, count=len(names))
+        # starts[row]: offset of name `row` in text
+        self.starts = np.zeros(len(names), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=self.starts[1:])
+        self.suffixes = self._sort_suffixes()
+
+    def _sort_suffixes(self):
+        codes = np.frombuffer(self.text.encode("utf-32-le"), dtype=np.uint32)
+        n = len(codes)
+        # Characters renumbered densely (SEPARATOR stays 0), then as many as fit
+        # packed into one int64 key, so the doubling starts from k chars rather than 1
+        _, dense = np.unique(codes, return_inverse=True)
+        bits = max(1, int(dense.max(initial=0)).bit_length())
+        k = max(1, 62 // bits)
+        key = np.zeros(n, dtype=np.int64)
+        for j in range(min(k, n)):
+            key <<= bits
+            key[:n - j] |= dense[j:]
+        order, rank = self._rank(key)
+        # Suffixes only need ordering by their first max_len characters:
+        # a query longer than every name cannot match anyway
+        while k < self.max_len and rank[order[-1]] < n:
+            shifted = np.zeros(n, dtype=np.int64)
+            shifted[:n - k] = rank[k:]
+            order, rank = self._rank(rank * (n + 1) + shifted)
+            k *= 2
+        return order.astype(np.int32 if n < 2 ** 31 else np.int64)
+
+    @staticmethod
+    def _rank(key):
+        """Sort order of `key` and the dense rank (1..) of every position"""
+        order = np.argsort(key, kind="stable")
+        changed = np.empty(len(key), dtype=np.int64)
+        if len(key):
+            changed[0] = 1
+            changed[1:] = key[order[1:]] != key[order[:-1]]
+        rank = np.empty(len(key), dtype=np.int64)
+        rank[order] = np.cumsum(changed)
+        return order, rank
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def nbytes(self):
+        return self.suffixes.nbytes + self.starts.nbytes + len(self.text.encode("utf-8"))
+
+    def _span(self, query):
+        """[lo, hi) of the suffixes that start with `query`"""
+        m = len(query)
+        text = self.text
+        key = lambda pos: text[pos:pos + m]
+        lo = bisect_left(self.suffixes, query, key=key)
+        hi = bisect_right(self.suffixes, query, lo=lo, key=key)
+        return lo, hi
+
+    def rows_containing(self, query):
+        """Sorted rows of the names that contain `query`"""
+        if not query or SEPARATOR in query or len(query) > self.max_len:
+            return np.zeros(0, dtype=np.int64)
+        lo, hi = self._span(query)
+        # Sorted positions make searchsorted walk starts in order, and its output sorted
+        positions = np.sort(self.suffixes[lo:hi])
+        rows = np.searchsorted(self.starts, positions, side="right") - 1
+        return rows[np.concatenate(([True], rows[1:] != rows[:-1]))] if len(rows) else rows
+
+    def count(self, query):
+        """Occurrences of `query` over all names (a name may hold several)"""
+        if not query or SEPARATOR in query or len(query) > self.max_len:
+            return 0
+        lo, hi = self._span(query)
+        return hi - lo
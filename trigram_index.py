@@ -0,0 +1,216 @@
+import os
+import math
+
+import numpy as np
+
+from master_store import replace_file
+
+COUNT_BUCKETS = 64
+
+# ---------------------------------------
+# Posting lists used to shortlist master names before they are sent to
+# RapidFuzz. The postings are per character occurrence ("the 2nd 'a' of a
+# name"): at the default threshold of 70 a trigram count bound keeps about
+# a third of all names, the character count bound about 0.5%. Gathered
+# names are verified against per-name character counts in COUNT_BUCKETS
+# buckets (a-z, 0-9, space, the rest hashed), which can only overcount.
+# ---------------------------------------
+
+
+def char_tokens(text):
+    """One int64 per character of `text`: code point << 32 | occurrence (1 for the first 'a', 2 for the second...)"""
+    seen = {}
+    tokens = []
+    for ch in text:
+        k = seen.get(ch, 0) + 1
+        seen[ch] = k
+        tokens.append(ord(ch) << 32 | k)
+    return tokens
+
+
+def char_counts(text):
+    """Characters of `text` counted into COUNT_BUCKETS buckets; merged buckets only ever overcount"""
+    counts = np.zeros(COUNT_BUCKETS, dtype=np.int64)
+    for ch in text:
+        counts[char_bucket(ch)] += 1
+    return counts
+
+
+def char_bucket(ch):
+    if "a" <= ch <= "z":
+        return ord(ch) - 97
+    if "0" <= ch <= "9":
+        return ord(ch) - 22
+    if ch == " ":
+        return 36
+    return 37 + ord(ch) % (COUNT_BUCKETS - 37)
+
+
+class TrigramIndex:
+    def __init__(self, names=()):
+        """
+        names: normalized master names; the position of each name is its row id
+
+        Rows are numbered by slot, their position in `order` (rows sorted by
+        name length), so every name length is one contiguous slot range.
+        Postings are one sorted int64 array of  token rank * len(names) + slot,
+        so one searchsorted() finds any token's slots within a length range.
+        counts[bucket, slot] holds character counts to verify gathered slots.
+        The same arrays are what save() writes and load() memory-maps.
+        """
+        self.tokens = np.zeros(0, dtype=np.int64)
+        self.postings = np.zeros(0, dtype=np.int64)
+        self.order = np.zeros(0, dtype=np.int32)
+        self.lengths = np.zeros(0, dtype=np.int32)
+        self.counts = np.zeros((COUNT_BUCKETS, 0), dtype=np.uint8)
+        self.names = np.zeros(0, dtype=object)
+        self.build(names)
+
+    def build(self, names):
+        names = list(names)
+        self.lengths = np.fromiter(map(len, names), dtype=np.int32, count=len(names))
+        self.order = np.argsort(self.lengths, kind="stable").astype(np.int32)
+        n = len(names)
+        text = "".join(names[row] for row in self.order.tolist())
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+        slot_of = np.repeat(np.arange(n, dtype=np.int64), self.lengths[self.order])
+
+        # Occurrence number of each character within its name: rank inside its (slot, char) group
+        by_char = np.argsort(slot_of << 21 | codes, kind="stable")
+        grouped = (slot_of << 21 | codes)[by_char]
+        first = np.ones(len(grouped), dtype=bool)
+        first[1:] = grouped[1:] != grouped[:-1]
+        group_start = np.maximum.accumulate(np.where(first, np.arange(len(grouped)), 0))
+        occurrence = np.empty(len(grouped), dtype=np.int64)
+        occurrence[by_char] = np.arange(len(grouped)) - group_start + 1
+
+        keys = codes << 32 | occurrence
+        self.tokens, rank = np.unique(keys, return_inverse=True)
+        self.postings = np.sort(rank.astype(np.int64).reshape(-1) * n + slot_of)
+
+        # Character counts per bucket and slot, one row per bucket (saturating at 255)
+        buckets = np.full(len(codes), 37, dtype=np.int64) + codes % (COUNT_BUCKETS - 37)
+        letters = (codes >= 97) & (codes <= 122)
+        digits = (codes >= 48) & (codes <= 57)
+        buckets[letters] = codes[letters] - 97
+        buckets[digits] = codes[digits] - 22
+        buckets[codes == 32] = 36
+        counts = np.bincount(slot_of * COUNT_BUCKETS + buckets, minlength=n * COUNT_BUCKETS)
+        self.counts = np.minimum(counts, 255).astype(np.uint8).reshape(n, COUNT_BUCKETS).T.copy()
+        self._set_names(names)
+
+    def _set_names(self, names):
+        # Object array sharing the caller's strings, so a shortlist is gathered with one take()
+        self.names = np.empty(len(names), dtype=object)
+        self.names[:] = names
+        # Derived from lengths: slot -> name length, and the first slot of every length
+        self._slot_lengths = np.asarray(self.lengths)[np.asarray(self.order)]
+        self._length_starts = np.zeros(int(self._slot_lengths.max(initial=0)) + 2, dtype=np.int64)
+        np.cumsum(np.bincount(self._slot_lengths, minlength=len(self._length_starts) - 1),
+                  out=self._length_starts[1:])
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def save(self, path):
+        """Write the index as path.tokens.npy / .postings.npy / .counts.npy / .order.npy / .len.npy"""
+        # Replaced, not rewritten: other processes may have the previous files memory-mapped
+        for suffix, values in ((".tokens.npy", self.tokens), (".postings.npy", self.postings),
+                               (".counts.npy", self.counts),
+                               (".order.npy", self.order), (".len.npy", self.lengths)):
+            replace_file(path + suffix, lambda f: np.save(f, values))
+
+    @classmethod
+    def load(cls, path, names):
+        """
+        Memory-map an index written by save(); names must be the list it was built from.
+        Returns None if no index was saved at `path` (or one in an older format)
+        or it does not match `names`.
+        """
+        for suffix in (".postings.npy", ".counts.npy", ".len.npy"):
+            if not os.path.exists(path + suffix):
+                return None
+        index = cls()
+        index.tokens = np.load(path + ".tokens.npy", mmap_mode="r")
+        index.postings = np.load(path + ".postings.npy", mmap_mode="r")
+        index.counts = np.load(path + ".counts.npy", mmap_mode="r")
+        index.order = np.load(path + ".order.npy", mmap_mode="r")
+        index.lengths = np.load(path + ".len.npy", mmap_mode="r")
+        if len(index.lengths) != len(names) or len(index.order) != len(names) or index.counts.shape[1] != len(names):
+            return None
+        index._set_names(names)
+        return index
+
+    def candidates(self, phrase, threshold):
+        """
+        Sorted rows whose fuzz.ratio against `phrase` can still reach `threshold`.
+
+        fuzz.ratio is 200 * LCS / (la + lb), and the LCS never exceeds the
+        characters the two strings share counted with multiplicity. So a name of
+        length lb needs  L(lb) = ceil(threshold * (la + lb) / 200)  of the la
+        character tokens of `phrase`. Such a name misses at most la - L(lb) of
+        them and must hold one of the la - L(lb) + 1 rarest ones (prefix
+        filtering). Only those tokens' postings within the length range they
+        apply to are gathered; the resulting slots are then checked against the
+        bucketed character counts of `phrase`, only in the buckets it uses.
+        Nothing RapidFuzz would accept is dropped, and the cost follows the
+        names sharing rare characters with `phrase`, not the size of the index.
+        """
+        la = len(phrase)
+        n = len(self.lengths)
+        if la == 0 or n == 0:
+            return np.zeros(0, dtype=np.int32)
+        t = float(threshold)
+        if t <= 0:
+            return np.arange(n, dtype=np.int32)
+
+        # ratio <= 200 * min(la, lb) / (la + lb) bounds the usable name lengths
+        min_len = max(1, math.ceil(la * t / (200 - t) - 1e-9))
+        max_len = min(math.floor(la * (200 - t) / t + 1e-9), len(self._length_starts) - 2)
+        if max_len < min_len:
+            return np.zeros(0, dtype=np.int32)
+        # need[lb - min_len]: shared character tokens a name of length lb needs (non-decreasing in lb)
+        need = np.ceil(t * (la + np.arange(min_len, max_len + 1)) / 200 - 1e-9).astype(np.int64)
+
+        keys = np.array(char_tokens(phrase), dtype=np.int64)
+        rank = np.minimum(np.searchsorted(self.tokens, keys), max(len(self.tokens) - 1, 0))
+        known = self.tokens[rank] == keys if len(self.tokens) else np.zeros(la, dtype=bool)
+        rank = rank[known].astype(np.int64)
+        if not len(rank):
+            return np.zeros(0, dtype=np.int32)
+        # Tokens missing from the index are the rarest of all: they sit at the head of the prefix
+        missing = la - len(rank)
+        sizes = np.searchsorted(self.postings, rank * n + n) - np.searchsorted(self.postings, rank * n)
+        rank = rank[np.argsort(sizes, kind="stable")]
+
+        # The i-th rarest token is in the prefix of every length with need <= la - i
+        i = np.arange(missing, la)
+        last_len = min_len + np.searchsorted(need, la - i, side="right") - 1
+        used = last_len >= min_len
+        if not used.any():
+            return np.zeros(0, dtype=np.int32)
+        lo = self._length_starts[min_len]
+        hi = self._length_starts[last_len[used] + 1]
+        starts = np.searchsorted(self.postings, rank[used] * n + lo)
+        ends = np.searchsorted(self.postings, rank[used] * n + hi)
+        counts = ends - starts
+        total = int(counts.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.int32)
+        if total >= hi.max() - lo:
+            # The postings would cover the length range anyway (small indexes): verify all of it
+            slots = np.arange(lo, hi.max())
+        else:
+            gather = np.arange(total) - np.repeat(np.cumsum(counts) - counts - starts, counts)
+            seen = np.zeros(n, dtype=bool)
+            seen[self.postings[gather] % n] = True
+            slots = np.flatnonzero(seen)
+
+        # Shared characters of every gathered slot, bounded from its bucketed character counts
+        shared = np.zeros(len(slots), dtype=np.int64)
+        phrase_counts = char_counts(phrase)
+        for bucket in np.flatnonzero(phrase_counts).tolist():
+            shared += np.minimum(self.counts[bucket][slots], phrase_counts[bucket])
+        required = need[self._slot_lengths[slots] - min_len]
+        rows = np.asarray(self.order)[slots[shared >= required]]
+        return np.sort(rows).astype(np.int32)
@@ -0,0 +1,84 @@
+from collections import Counter
+
+from normalizer import Normalizer
+
+# ---------------------------------------
+# Master-name vocabulary and the stop words derived from it, shared by
+# match3_stop and contextmatch
+# ---------------------------------------
+_normalizer = Normalizer()
+
+
+def tokenize(text):
+    """Lower-cased alphanumeric runs, i.e. match3_stop.normalize(text).split()"""
+    return _normalizer(text)[1]
+
+
+class Vocabulary:
+    def __init__(self, stop_word_candidates=()):
+        """
+        Token document frequencies over master names, kept current by add() /
+        remove() / rename() at the cost of tokenizing that one name.
+            master_vocab  frozenset of tokens found in at least one name
+            stop_words    the candidates that are not master tokens, so a
+                          master called e.g. "Total Sales Ltd" keeps "total"
+        Both frozensets are cached and only rebuilt on the first read after a
+        token enters or leaves the vocabulary.
+        """
+        self.candidates = frozenset(stop_word_candidates)
+        self.doc_freq = Counter()  # token -> number of names containing it
+        self.names = 0
+        self._master_vocab = None
+        self._stop_words = None
+
+    @classmethod
+    def from_names(cls, names, stop_word_candidates=()):
+        vocab = cls(stop_word_candidates)
+        for name in names:
+            vocab.add(name)
+        return vocab
+
+    def add(self, name):
+        self.names += 1
+        for token in set(tokenize(name)):
+            self.doc_freq[token] += 1
+            if self.doc_freq[token] == 1:
+                self._changed(token)
+
+    def remove(self, name):
+        """Undo an earlier add(name)"""
+        self.names -= 1
+        for token in set(tokenize(name)):
+            count = self.doc_freq[token] - 1
+            if count > 0:
+                self.doc_freq[token] = count
+            else:
+                del self.doc_freq[token]
+                self._changed(token)
+
+    def rename(self, old_name, new_name):
+        self.remove(old_name)
+        self.add(new_name)
+
+    def _changed(self, token):
+        self._master_vocab = None
+        if token in self.candidates:
+            self._stop_words = None
+
+    def __contains__(self, token):
+        return token in self.doc_freq
+
+    def __len__(self):
+        return len(self.doc_freq)
+
+    @property
+    def master_vocab(self):
+        if self._master_vocab is None:
+            self._master_vocab = frozenset(self.doc_freq)
+        return self._master_vocab
+
+    @property
+    def stop_words(self):
+        if self._stop_words is None:
+            self._stop_words = frozenset(w for w in self.candidates if w not in self.doc_freq)
+        return self._stop_words